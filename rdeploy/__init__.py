@@ -1,4 +1,16 @@
-from invoke import Collection
+import importlib
+import importlib.util
 
-from .tasks import *
 
+# Tasks are resolved lazily so that the `rdeploy` console script can forward
+# commands to a running daemon without importing the whole task collection.
+def __getattr__(name):
+    # Leave submodules to the import system, e.g. `from rdeploy import kube`
+    if importlib.util.find_spec(f'rdeploy.{name}') is not None:
+        raise AttributeError(name)
+
+    tasks = importlib.import_module('rdeploy.tasks')
+    try:
+        return getattr(tasks, name)
+    except AttributeError:
+        raise AttributeError(f"module 'rdeploy' has no attribute '{name}'") from None
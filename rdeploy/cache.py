@@ -0,0 +1,50 @@
+"""
+Small JSON file caches kept under the rdeploy cache directory.
+
+Only the standard library is used here so that the thin `rdeploy` client
+can share these helpers.
+"""
+import json
+import os
+import tempfile
+import time
+
+
+def get_cache_dir():
+    """Returns the rdeploy cache directory, honouring $XDG_CACHE_HOME"""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'rdeploy')
+
+
+def load(name):
+    """Returns the contents of a cache file, or an empty dict"""
+    try:
+        with open(os.path.join(get_cache_dir(), name), 'r') as stream:
+            return json.load(stream)
+    except (OSError, ValueError):
+        return {}
+
+
+def save(name, data):
+    """Atomically replaces a cache file. Failures to write are ignored"""
+    cache_dir = get_cache_dir()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=f'.{name}.')
+        with os.fdopen(fd, 'w') as stream:
+            json.dump(data, stream)
+        os.replace(tmp_path, os.path.join(cache_dir, name))
+    except OSError:
+        pass
+
+
+def get_fresh(data, key, ttl):
+    """Returns a cached value if it was stored less than `ttl` seconds ago"""
+    entry = data.get(key)
+    if entry and time.time() - entry['time'] < ttl:
+        return entry['value']
+    return None
+
+
+def set_fresh(data, key, value):
+    data[key] = {'time': time.time(), 'value': value}
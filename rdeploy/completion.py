@@ -0,0 +1,155 @@
+"""
+Fast shell completion for the `rdeploy` console script.
+
+`rdeploy --complete -- <command line>` is answered from a small index in the
+cache directory holding task names, aliases, flags and the config names of
+the current rdeploy.yaml. Each part is rebuilt only when a file it was read
+from changes, so a completion normally costs a few stats and one JSON read,
+without importing invoke, the tasks or PyYAML.
+"""
+import os
+
+from rdeploy import cache
+
+
+INDEX = 'completion.json'
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Files the task part of the index is read from
+TASK_SOURCES = [os.path.join(PACKAGE_DIR, 'tasks.py'), os.path.join(PACKAGE_DIR, 'main.py')]
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _build_task_index():
+    from rdeploy.main import program
+
+    def flags(context):
+        return {name: context.flags[name].takes_value for name in context.flag_names()}
+
+    tasks = {}
+    for context in program.namespace.to_contexts():
+        tasks[context.name] = {
+            'aliases': list(context.aliases),
+            'flags': flags(context),
+            'positional': [argument.name for argument in context.positional_args],
+        }
+    return {'tasks': tasks, 'core_flags': flags(program.initial_context)}
+
+
+def _build_settings_index(path):
+    import yaml
+
+    try:
+        with open(path, 'r') as stream:
+            settings = yaml.safe_load(stream) or {}
+    except (OSError, yaml.YAMLError):
+        settings = {}
+    return {
+        'configs': sorted(settings.get('configs') or {}),
+        'rollouts': sorted(settings.get('rollouts') or {}),
+    }
+
+
+def load_index(settings_path='rdeploy.yaml'):
+    """
+    Returns the completion index, rebuilding the parts whose source files'
+    mtimes differ from those recorded in the cached copy.
+    """
+    index = cache.load(INDEX)
+    changed = False
+
+    task_key = [_mtime(path) for path in TASK_SOURCES]
+    if index.get('task_key') != task_key or 'tasks' not in index:
+        index.update(_build_task_index(), task_key=task_key)
+        changed = True
+
+    settings_path = os.path.realpath(settings_path)
+    settings_key = _mtime(settings_path)
+    entries = index.setdefault('settings', {})
+    entry = entries.get(settings_path)
+    if entry is None or entry['mtime'] != settings_key:
+        entry = dict(_build_settings_index(settings_path), mtime=settings_key)
+        entries[settings_path] = entry
+        changed = True
+
+    if changed:
+        cache.save(INDEX, index)
+    return index, entry
+
+
+def complete(words, settings_path='rdeploy.yaml'):
+    """
+    Returns the completion candidates for the words of a command line,
+    including the program name. As with invoke's own completion the last
+    word may be partial and the shell filters the candidates by prefix.
+    """
+    index, settings = load_index(settings_path)
+    tasks = index['tasks']
+    names = {}
+    for name, task in tasks.items():
+        names[name] = name
+        for alias in task['aliases']:
+            names[alias] = name
+
+    task, args, expects_value = None, [], False
+    tokens = list(words[1:])
+    tail = tokens.pop() if tokens else ''
+    for token in tokens:
+        flags = tasks[task]['flags'] if task else index['core_flags']
+        if expects_value:
+            expects_value = False
+        elif token.startswith('-'):
+            expects_value = '=' not in token and flags.get(token, False)
+        elif token in names and (task is None or len(args) >= len(tasks[task]['positional'])):
+            task, args = names[token], []
+        else:
+            args.append(token)
+
+    flags = tasks[task]['flags'] if task else index['core_flags']
+    if expects_value:
+        # Let the shell complete the flag's value, usually a file name
+        return []
+    if tail.startswith('-'):
+        if tail in flags:
+            return [] if flags[tail] else sorted(names)
+        if tail.startswith('--'):
+            return [flag for flag in flags if flag.startswith('--')]
+        return list(flags) if tail == '-' else []
+
+    def candidates(task, slot):
+        positional = tasks[task]['positional']
+        if slot >= len(positional):
+            return sorted(names)
+        if positional[slot] == 'config':
+            if task == 'upgrade':
+                return settings['configs'] + settings['rollouts']
+            return settings['configs']
+        return []
+
+    if task is None:
+        results = sorted(names)
+        if tail in names:
+            # The tail may be a complete task name, so offer its first argument too
+            results += [name for name in candidates(names[tail], 0) if name not in results]
+        return results
+
+    results = candidates(task, len(args))
+    if tail in results:
+        # The tail may be complete, so offer what could follow it too
+        results += [name for name in candidates(task, len(args) + 1) if name not in results]
+    return results
+
+
+def main(argv):
+    """Prints completions for `rdeploy --complete -- <command line>`"""
+    if '--' in argv:
+        words = argv[argv.index('--') + 1:]
+    else:
+        words = argv[argv.index('--complete') + 1:]
+    for candidate in complete(words):
+        print(candidate)
@@ -0,0 +1,241 @@
+"""
+Optional long-lived rdeploy daemon and the thin client used by the `rdeploy`
+console script.
+
+The client only imports the standard library so that forwarding a command to
+a running daemon does not pay for importing invoke, PyYAML or kubernetes.
+When no daemon is listening the command runs in-process as before.
+"""
+import io
+import json
+import os
+import socket
+import sys
+import threading
+import traceback
+
+from rdeploy.cache import get_cache_dir
+
+
+# Tasks that need the caller's terminal (pty, prompts), stream or wait until
+# interrupted or manage the daemon itself always run in-process. The daemon
+# runs one command at a time and cannot be interrupted from the client, so
+# long waits there would block every other client.
+LOCAL_TASKS = {
+    'serve',
+    'logs',
+    'bootstrap',
+    'shell', 'bash',
+    'manage',
+    'git_release', 'git-release',
+}
+# `upgrade` flags that wait on rollouts or image pulls
+LOCAL_UPGRADE_FLAGS = {'--waves', '--prepull'}
+LOCAL_UPGRADE_SHORT_FLAGS = {'w', 'p'}
+
+
+def get_socket_path():
+    """Returns the unix socket path used by `rdeploy serve`"""
+    if os.environ.get('RDEPLOY_SOCKET'):
+        return os.environ['RDEPLOY_SOCKET']
+    return os.path.join(get_cache_dir(), 'rdeploy.sock')
+
+
+def _connect(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def _send(sock, message):
+    sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+
+# Client
+########
+def forward(argv, socket_path=None):
+    """
+    Forwards a command line to a running daemon and relays its output.
+
+    Returns the command's exit code, or None when no daemon is available and
+    the caller should execute the command itself.
+    """
+    socket_path = socket_path or get_socket_path()
+    if not os.path.exists(socket_path):
+        return None
+
+    sock = _connect(socket_path)
+    if sock is None:
+        return None
+
+    with sock:
+        _send(sock, {
+            'argv': list(argv),
+            'cwd': os.getcwd(),
+            'env': dict(os.environ),
+        })
+        for line in sock.makefile('r', encoding='utf-8'):
+            message = json.loads(line)
+            if 'exit' in message:
+                return message['exit']
+            stream = sys.stderr if message['stream'] == 'stderr' else sys.stdout
+            stream.write(message['data'])
+            stream.flush()
+
+    print('rdeploy daemon closed the connection unexpectedly', file=sys.stderr)
+    return 1
+
+
+def stop(socket_path=None):
+    """Asks a running daemon to shut down. Returns False if none is running"""
+    sock = _connect(socket_path or get_socket_path())
+    if sock is None:
+        return False
+    with sock:
+        _send(sock, {'shutdown': True})
+        sock.makefile('r', encoding='utf-8').readline()
+    return True
+
+
+def _runs_in_process(args):
+    """Returns whether a command line must not be forwarded to the daemon"""
+    if LOCAL_TASKS.intersection(args):
+        return True
+    if 'upgrade' not in args:
+        return False
+    for arg in args[args.index('upgrade') + 1:]:
+        if arg in LOCAL_UPGRADE_FLAGS:
+            return True
+        if arg.startswith('-') and not arg.startswith('--') \
+                and LOCAL_UPGRADE_SHORT_FLAGS.intersection(arg[1:]):
+            return True
+    return False
+
+
+def main():
+    """Console script entry point"""
+    argv = sys.argv
+    if '--complete' in argv:
+        from rdeploy import completion
+        completion.main(argv)
+        return
+
+    if not os.environ.get('RDEPLOY_NO_DAEMON') and not _runs_in_process(argv[1:]):
+        code = forward(argv)
+        if code is not None:
+            sys.exit(code)
+
+    from rdeploy.main import program
+    program.run(argv)
+
+
+# Server
+########
+class _SocketStream(io.TextIOBase):
+    """Text stream that relays writes to the client as JSON messages"""
+
+    def __init__(self, sock, name, lock):
+        self._sock = sock
+        self._name = name
+        self._lock = lock
+
+    def write(self, data):
+        if data:
+            with self._lock:
+                _send(self._sock, {'stream': self._name, 'data': data})
+        return len(data)
+
+    def isatty(self):
+        return False
+
+
+def _execute(sock, request):
+    """Runs one forwarded command line, as the client would have in-process"""
+    from rdeploy.main import MainProgram, program
+
+    send_lock = threading.Lock()
+    saved = (os.getcwd(), dict(os.environ), sys.stdin, sys.stdout, sys.stderr)
+    code = 0
+    try:
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        sys.stdin = io.StringIO()
+        sys.stdout = _SocketStream(sock, 'stdout', send_lock)
+        sys.stderr = _SocketStream(sock, 'stderr', send_lock)
+        MainProgram(namespace=program.namespace, version=program.version).run(request['argv'])
+    except SystemExit as e:
+        if isinstance(e.code, int) or e.code is None:
+            code = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        cwd, environ, sys.stdin, sys.stdout, sys.stderr = saved
+        os.environ.clear()
+        os.environ.update(environ)
+        os.chdir(cwd)
+    return code
+
+
+def serve(socket_path=None):
+    """
+    Listens on a unix socket and executes forwarded commands in this process.
+
+    Commands are executed one at a time since they share the process working
+    directory, environment and standard streams. Settings, imported modules
+    and Kubernetes API clients stay warm between commands.
+    """
+    import socketserver
+
+    # Warm up the expensive imports before accepting connections
+    import kubernetes.client  # noqa: F401
+    import rdeploy.main  # noqa: F401
+
+    socket_path = socket_path or get_socket_path()
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    if os.path.exists(socket_path):
+        sock = _connect(socket_path)
+        if sock is not None:
+            sock.close()
+            sys.exit(f'rdeploy daemon already running on {socket_path}')
+        os.unlink(socket_path)
+
+    execute_lock = threading.Lock()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            request = json.loads(self.rfile.readline())
+            if request.get('shutdown'):
+                _send(self.request, {'exit': 0})
+                threading.Thread(target=self.server.shutdown).start()
+                return
+            with execute_lock:
+                code = _execute(self.request, request)
+            _send(self.request, {'exit': code})
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    old_umask = os.umask(0o077)
+    try:
+        server = Server(socket_path, Handler)
+    finally:
+        os.umask(old_umask)
+
+    print(f'rdeploy daemon listening on {socket_path}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
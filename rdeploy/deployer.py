@@ -0,0 +1,907 @@
+"""
+Importable Python API for rdeploy.
+
+The invoke tasks in rdeploy.tasks are thin wrappers around `Deployer` and
+`ConfigHandle`, so pipelines can run the same steps in-process without
+spawning the CLI for each one:
+
+    from rdeploy.deployer import Deployer
+
+    deployer = Deployer()
+    tag = deployer.next_version('patch')
+    deployer.config('staging').upgrade(tag)
+    print(deployer.config('staging').live_image())
+
+Settings, Kubernetes API clients and caches are shared by every call made
+through the same process.
+"""
+import math
+import os
+import re
+import sys
+import tarfile
+import tempfile
+import threading
+import urllib.request
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import semver
+from invoke import Context
+from invoke.exceptions import UnexpectedExit
+from packaging import version
+
+from rdeploy import cache, kube, tools
+from rdeploy.exceptions import ExecuteError, ReleaseError
+from rdeploy.policies import get_policy, run_with_policy
+from rdeploy.streams import LineParser, YamlDocumentParser, stream_run
+from rdeploy.utils import (get_settings, get_kube_context, get_fleet_status, get_helm_bin,
+                           decode_data_fields, build_management_cmd,
+                           build_bootstrap_manifest)
+from rdeploy.values import deploy_fingerprint, merged_values
+
+
+# Fingerprints of the last upgrade of each release, see `ConfigHandle.upgrade`
+DEPLOYS_CACHE = 'deploys.json'
+_deploys_lock = threading.Lock()
+
+ROLLOUT_DEFAULTS = {'configs': None, 'waves': None, 'concurrency': 4,
+                    'timeout': 600, 'on_failure': 'rollback'}
+
+
+class Deployer:
+    """
+    Entry point to the rdeploy API for one rdeploy.yaml.
+
+    Commands run through `ctx` (a fresh invoke Context by default). They are
+    only echoed when `echo` is set, as the CLI does.
+    """
+
+    def __init__(self, settings_path='rdeploy.yaml', ctx=None, echo=False):
+        self.settings_path = settings_path
+        self.ctx = ctx or Context()
+        self.echo = echo
+        self._handles = {}
+
+    @property
+    def settings(self):
+        return get_settings(self.settings_path)
+
+    def config(self, name):
+        """Returns the handle for a config in rdeploy.yaml"""
+        if name not in self.settings['configs']:
+            raise KeyError(f'Unknown config: {name}')
+        if name not in self._handles:
+            self._handles[name] = ConfigHandle(self, name)
+        return self._handles[name]
+
+    def configs(self):
+        """Returns handles for every config in rdeploy.yaml"""
+        return [self.config(name) for name in self.settings['configs']]
+
+    def policy(self, name):
+        """Returns the timeout/retry policy of a command class, see `rdeploy.policies`"""
+        settings_dict = self.settings if os.path.exists(self.settings_path) else {}
+        return get_policy(settings_dict, name)
+
+    def run(self, command, echo=False, policy=None, **kwargs):
+        """
+        Runs a shell command, echoing it if both `echo` and the deployer allow.
+        When a command class is given as `policy`, its timeout, retries and
+        hedging apply.
+        """
+        if policy:
+            return run_with_policy(self.ctx, command, self.policy(policy),
+                                   echo=echo and self.echo, **kwargs)
+        return self.ctx.run(command, echo=echo and self.echo, **kwargs)
+
+    # Versioning Helpers
+    ####################
+    def _latest_tag(self, regex):
+        """
+        Returns the highest version tag matching `regex`, without the v prefix.
+        Tags are streamed so only the first match is kept in memory.
+        """
+        self.run('git fetch --tags', policy='git_fetch')
+        matches = []
+
+        def on_line(tag):
+            if not matches and regex.search(tag):
+                matches.append(tag)
+
+        stream_run(self.ctx, 'git tag --sort=-v:refname', LineParser(on_line), hide='both')
+        if not matches:
+            raise ReleaseError('No valid semver tags found in repository')
+        latest_tag = matches[0]
+        return latest_tag[1:] if latest_tag.startswith('v') else latest_tag
+
+    def latest_version(self):
+        """Checks the git tags and returns the current latest version"""
+        return self._latest_tag(re.compile(r'^v?(0|[1-9]\d*)\.(0|[1-9]\d*)\.(0|[1-9]\d*)$'))
+
+    def latest_prerelease(self, version):
+        """Checks the git tags and returns the latest pre-release of a version"""
+        return self._latest_tag(re.compile(r'^v?{}(?:-((?:0|[1-9]\d*|\d*[a-zA-Z-][0-9a-zA-Z-]*)(?:\.(?:0|[1-9]\d*|\d*[a-zA-Z-][0-9a-zA-Z-]*))*))?(?:\+([0-9a-zA-Z-]+(?:\.[0-9a-zA-Z-]+)*))?$'.format(version)))
+
+    def next_version(self, bump):
+        """Returns incremented version number by looking at git tags"""
+        # Get latest git tag:
+        try:
+            latest_tag = self.latest_version()
+        except ReleaseError:
+            latest_tag = '0.0.0'
+
+        increment = {
+            'build': semver.bump_build,
+            'patch': semver.bump_patch,
+            'minor': semver.bump_minor,
+            'major': semver.bump_major
+        }
+
+        if bump in ['pre-patch', 'pre-minor', 'pre-major']:
+            incremented = increment[bump[4:]](latest_tag)
+            try:
+                # Try to increment the pre-release if there are existing pre-releases
+                incremented = semver.bump_prerelease(self.latest_prerelease(incremented))
+            except (ReleaseError, ValueError):
+                # No existing pre-release, so create one
+                incremented = semver.bump_prerelease(incremented)
+        else:
+            incremented = increment[bump](latest_tag)
+
+        return incremented
+
+    # Fleet
+    #######
+    def status(self, configs=None, ttl=10):
+        """
+        Returns the deployment status of the given configs (all by default),
+        keyed by config name. See `utils.get_fleet_status`.
+        """
+        if configs is None:
+            configs = list(self.settings['configs'])
+        return get_fleet_status(self.settings, configs, ttl=ttl)
+
+    def doctor(self, configs=None):
+        """
+        Probes the tools needed by the given configs, all of them by default,
+        concurrently. Without an rdeploy.yaml every tool rdeploy may use is
+        probed. Returns the results of `tools.probe`, with an `error` for
+        helm binaries that do not match a config's helm_version.
+        """
+        if configs is None:
+            configs = list(self.settings['configs']) if os.path.exists(self.settings_path) else []
+
+        required = []
+        expected = {}
+        for name in configs:
+            handle = self.config(name)
+            for tool in handle.required_tools():
+                if tool not in required:
+                    required.append(tool)
+            if handle.config_dict.get('helm_version'):
+                expected[handle.helm_bin] = str(handle.config_dict['helm_version'])
+        if not configs:
+            required = [(tool, tool) for tool in ('helm', 'kubectl', 'gcloud', 'az', 'docker', 'git')]
+
+        results = tools.probe(required)
+        for result in results:
+            helm_version = expected.get(result['binary'])
+            if result['tool'] == 'helm' and result['version'] and helm_version \
+                    and version.parse(result['version']) != version.parse(helm_version):
+                result['error'] = f'expected {helm_version}'
+        return results
+
+    # Rollouts
+    ##########
+    def rollout_settings(self, name):
+        """Returns a rollout of rdeploy.yaml with its defaults filled in"""
+        rollouts = self.settings.get('rollouts') or {}
+        if name not in rollouts:
+            raise KeyError(f'Unknown rollout: {name}')
+        rollout = dict(ROLLOUT_DEFAULTS)
+        rollout.update(rollouts[name])
+        if rollout['on_failure'] not in ('rollback', 'stop'):
+            raise ExecuteError("Rollout on_failure must be 'rollback' or 'stop'")
+        return rollout
+
+    def rollout_waves(self, name):
+        """
+        Splits a rollout's configs into waves, returned as a list of
+        (wave name, config names). A wave takes its listed `configs`, or
+        `percent` of all the rollout's configs, from those not yet assigned.
+        A wave with neither, and any configs left over, take the rest.
+        """
+        rollout = self.rollout_settings(name)
+        remaining = list(rollout.get('configs') or self.settings['configs'])
+        for config in remaining:
+            self.config(config)
+        total = len(remaining)
+
+        waves = []
+        for index, wave in enumerate(rollout.get('waves') or []):
+            if wave.get('configs'):
+                configs = [config for config in remaining if config in wave['configs']]
+            elif wave.get('percent'):
+                configs = remaining[:max(1, math.ceil(total * wave['percent'] / 100))]
+            else:
+                configs = list(remaining)
+            remaining = [config for config in remaining if config not in configs]
+            if configs:
+                waves.append((wave.get('name') or 'wave {}'.format(index + 1), configs))
+        if remaining:
+            waves.append(('rest', remaining))
+        return waves
+
+    def _upgrade_and_wait(self, config, version, timeout, prepull, skip_unchanged, started):
+        """Adds the config to `started` once its helm upgrade runs"""
+        handle = self.config(config)
+        try:
+            handle.upgrade(version, switch_context=False, prepull=prepull,
+                           skip_unchanged=skip_unchanged,
+                           on_helm_start=lambda: started.append(config), hide=True)
+        except UnexpectedExit as e:
+            raise ExecuteError(e.result.stderr.strip() or f'helm upgrade exited with {e.result.exited}')
+        handle.wait_until_ready(timeout=timeout)
+
+    def rollout(self, name, version, on_wave=None, prepull=False, skip_unchanged=False):
+        """
+        Upgrades the configs of a rollout to `version` wave by wave. The
+        configs of a wave are upgraded concurrently, up to the rollout's
+        `concurrency`, and the next wave only starts once every deployment
+        of the current one is fully rolled out.
+
+        When a config fails, no further waves are started and, unless the
+        rollout's `on_failure` is 'stop', every config upgraded so far is
+        rolled back. `on_wave(wave name, errors)` is called after each wave
+        with the error of each of its configs, None on success.
+
+        With `prepull`, each config pulls the image onto its nodes before
+        its helm upgrade, see `ConfigHandle.prepull`. With `skip_unchanged`,
+        configs whose upgrade would be a no-op are skipped, see
+        `ConfigHandle.upgrade`. Only configs whose helm upgrade ran are
+        rolled back.
+
+        Returns a dict with `succeeded`, the `waves` as passed to `on_wave`
+        and the configs that were `rolled_back`.
+        """
+        rollout = self.rollout_settings(name)
+        result = {'succeeded': True, 'waves': [], 'rolled_back': []}
+        upgraded = []
+
+        with ThreadPoolExecutor(max_workers=rollout['concurrency']) as executor:
+            for wave_name, configs in self.rollout_waves(name):
+                # Only releases helm has touched are rolled back, a failed
+                # helm upgrade may still have created a new revision
+                futures = {config: executor.submit(self._upgrade_and_wait, config, version,
+                                                   rollout['timeout'], prepull, skip_unchanged,
+                                                   upgraded)
+                           for config in configs}
+                errors = {}
+                for config, future in futures.items():
+                    try:
+                        future.result()
+                        errors[config] = None
+                    except (Exception, ExecuteError) as e:
+                        errors[config] = str(e)
+                result['waves'].append((wave_name, errors))
+                if on_wave:
+                    on_wave(wave_name, errors)
+
+                if any(errors.values()):
+                    result['succeeded'] = False
+                    if rollout['on_failure'] == 'rollback':
+                        list(executor.map(self._rollback, upgraded))
+                        result['rolled_back'] = upgraded
+                    break
+        return result
+
+    def _rollback(self, config):
+        self.config(config).rollback(switch_context=False, warn=True)
+
+
+class ConfigHandle:
+    """Operations on a single config of rdeploy.yaml"""
+
+    def __init__(self, deployer, name):
+        self.deployer = deployer
+        self.name = name
+
+    def __repr__(self):
+        return f'<ConfigHandle {self.name!r}>'
+
+    @property
+    def settings_dict(self):
+        return self.deployer.settings
+
+    @property
+    def config_dict(self):
+        return self.settings_dict['configs'][self.name]
+
+    @property
+    def provider_data(self):
+        return self.config_dict.get('cloud_provider') or {}
+
+    @property
+    def kube_context(self):
+        return get_kube_context(self.settings_dict, self.config_dict)
+
+    @property
+    def helm_bin(self):
+        return get_helm_bin(self.config_dict)
+
+    def required_tools(self):
+        """Returns the (tool, binary) pairs this config's tasks run"""
+        if self._is_versioned() and self.provider_data.get('name') == 'azure':
+            cloud_cli = 'az'
+        else:
+            cloud_cli = 'gcloud'
+        return [('helm', self.helm_bin), ('kubectl', 'kubectl'), (cloud_cli, cloud_cli),
+                ('docker', 'docker'), ('git', 'git')]
+
+    def _is_versioned(self):
+        settings_version = self.settings_dict.get('version')
+        return settings_version and version.parse(str(settings_version)) > version.parse('1')
+
+    def _run(self, command, **kwargs):
+        return self.deployer.run(command, **kwargs)
+
+    # Cluster Activation
+    ####################
+    def set_project(self):
+        """Sets the active gcloud project or azure subscription"""
+        if self._is_versioned():
+            provider_data = self.config_dict.get('cloud_provider')
+            if provider_data and provider_data['name'] == 'azure':
+                return self._run('az account set -s {subscription}'
+                                 .format(subscription=provider_data['subscription_id']), echo=True)
+            elif provider_data and provider_data['name'] == 'gcp':
+                return self._run('gcloud config set project {project}'
+                                 .format(project=provider_data['project']), echo=True)
+        else:
+            return self._run('gcloud config set project {project}'
+                             .format(project=self.config_dict['cloud_project']), echo=True)
+
+    def _use_existing_context(self, kube_context, force):
+        if force or not kube.has_fresh_credentials(kube_context):
+            return False
+        self._run('kubectl config use-context {kube_context}'
+                  .format(kube_context=kube_context),
+                  echo=True)
+        return True
+
+    def set_cluster(self, force=False):
+        """
+        Sets the active cluster. Credentials are only fetched when the kube
+        context is missing or its credentials have expired, unless `force`.
+
+        Returns True if credentials were fetched from the cloud provider.
+        """
+        config_dict = self.config_dict
+
+        if self._is_versioned():
+            provider_data = config_dict.get('cloud_provider')
+            if provider_data['name'] == 'azure':
+                if self._use_existing_context('{name}_{cluster}_{region}'
+                                              .format(cluster=provider_data['kube_cluster'],
+                                                      region=provider_data['region'],
+                                                      name=provider_data['name']), force):
+                    return False
+
+                self._run('az aks get-credentials -g {group} -n {cluster} --context aks-{region}-{cluster} --context {name}_{cluster}_{region}  --overwrite-existing'
+                          .format(group=provider_data['resource_group'],
+                                  cluster=provider_data['kube_cluster'],
+                                  region=provider_data['region'],
+                                  name=provider_data['name']
+                                  ), echo=True, policy='credentials')
+            elif provider_data['name'] == 'gcp':
+                if provider_data.get('zone'):
+                    zone_or_region_param = '--zone {}'.format(provider_data['zone'])
+                    zone = provider_data['zone']
+                elif provider_data.get('region'):
+                    zone_or_region_param = '--region {}'.format(provider_data['region'])
+                    zone = provider_data['region']
+
+                if self._use_existing_context('{name}_{project}_{cluster}_{zone}'
+                                              .format(cluster=provider_data['kube_cluster'],
+                                                      project=provider_data['project'],
+                                                      name=provider_data['name'],
+                                                      zone=zone), force):
+                    return False
+
+                self._run('gcloud container clusters get-credentials {cluster}'
+                          ' --project {project} {zone_or_region_param}'
+                          .format(cluster=provider_data['kube_cluster'],
+                                  project=provider_data['project'],
+                                  zone_or_region_param=zone_or_region_param),
+                          echo=True, policy='credentials')
+
+                self._run('kubectl config rename-context gke_{project}_{zone}_{cluster}'
+                          ' {name}_{project}_{cluster}_{zone}'
+                          .format(cluster=provider_data['kube_cluster'],
+                                  project=provider_data['project'],
+                                  name=provider_data['name'],
+                                  zone=zone),
+                          echo=True)
+            else:
+                sys.exit(f"Unsupported provider: {provider_data['name']}")
+        else:
+            if config_dict.get('cloud_zone'):
+                zone_or_region_param = '--zone {}'.format(config_dict['cloud_zone'])
+                zone = config_dict['cloud_zone']
+            elif config_dict.get('cloud_region'):
+                zone_or_region_param = '--region {}'.format(config_dict['cloud_region'])
+                zone = config_dict['cloud_region']
+            else:
+                zone_or_region_param = '--zone europe-west1-c'
+                zone = 'europe-west1-c'
+
+            if self._use_existing_context('gcp_{project}_{cluster}_{zone}'
+                                          .format(cluster=config_dict['cluster'],
+                                                  project=config_dict['cloud_project'],
+                                                  zone=zone), force):
+                return False
+
+            self._run('gcloud container clusters get-credentials {cluster}'
+                      ' --project {project} {zone_or_region_param}'
+                      .format(cluster=config_dict['cluster'],
+                              project=config_dict['cloud_project'],
+                              zone_or_region_param=zone_or_region_param),
+                      echo=True, policy='credentials')
+
+            self._run('kubectl config rename-context gke_{project}_{zone}_{cluster}'
+                      ' gcp_{project}_{cluster}_{zone}'
+                      .format(cluster=config_dict['cluster'],
+                              project=config_dict['cloud_project'],
+                              zone=zone),
+                      echo=True)
+        return True
+
+    def activate(self, force=False):
+        """
+        Fetches and sets the project, cluster and namespace.
+        Returns True if credentials were fetched from the cloud provider.
+        """
+        self.set_project()
+        fetched = self.set_cluster(force=force)
+        self._run('kubectl config use-context $(kubectl config current-context)'
+                  ' --namespace={namespace}'
+                  .format(namespace=self.config_dict['namespace']),
+                  echo=True)
+        return fetched
+
+    def set_context(self):
+        """Switch cluster and namespace"""
+        self._run('kubectl config use-context {kube_context}'
+                  .format(kube_context=self.kube_context),
+                  echo=True)
+        return self._run('kubectl config set-context --current --namespace={namespace}'
+                         .format(namespace=self.config_dict['namespace']),
+                         echo=True)
+
+    # Kubernetes and GCloud Commands
+    ################################
+    def create_namespace(self):
+        self.set_context()
+        return self._run('kubectl create namespace {namespace}'
+                         .format(namespace=self.config_dict['namespace']),
+                         echo=True)
+
+    def upload_secrets(self, env_file):
+        """Replaces the project's secret with the contents of an env file"""
+        self.set_context()
+
+        self._run('kubectl delete secret {project_name}'
+                  .format(project_name=self.config_dict['project_name']),
+                  warn=True)
+
+        return self._run('kubectl create secret generic {project_name}'
+                         ' --from-env-file {env_file}'
+                         .format(project_name=self.config_dict['project_name'],
+                                 env_file=env_file))
+
+    def decode_secret(self, secret):
+        """Returns a kubernetes secret with its data values decoded"""
+        return decode_data_fields(kube.read_secret(secret, self.config_dict['namespace'],
+                                                   self.kube_context))
+
+    def upload_static(self, bucket_name):
+        """Upload static files to gcloud bucket"""
+        self.set_project()
+
+        self._run('echo "yes\n" | python src/manage.py collectstatic')
+        return self._run('gsutil -m rsync -d -r var/www/static gs://{bucket_name}'
+                         .format(bucket_name=bucket_name), echo=False)
+
+    def create_bucket(self, bucket_name):
+        """Creates gcloud bucket for static files"""
+        self.set_project()
+
+        self._run('gsutil mb gs://{bucket_name}'
+                  .format(bucket_name=bucket_name), echo=False)
+        return self._run('gsutil defacl set private gs://{bucket_name}'
+                         .format(bucket_name=bucket_name), echo=False)
+
+    def create_public_bucket(self, bucket_name):
+        """Creates public gcloud bucket for static files"""
+        self.set_project()
+
+        self._run('gsutil mb -b on gs://{bucket_name}'.format(bucket_name=bucket_name))
+        return self._run('gsutil iam ch allUsers:objectViewer gs://{bucket_name}'
+                         .format(bucket_name=bucket_name))
+
+    # Helm
+    ######
+    def helm_chart(self, add_repo=False):
+        """
+        Returns the chart reference to install from. Logs in to the GCP
+        Artifact Registry when one is configured, otherwise optionally adds
+        the Rehive helm repo.
+        """
+        provider_data = self.provider_data
+        helm_registry = provider_data.get('helm_registry')
+        if provider_data.get('name') == 'gcp' and helm_registry:
+            # Authenticate with the GCP Artifact Registry
+            self._run('gcloud auth print-access-token | {helm_bin} registry login -u oauth2accesstoken --password-stdin https://{helm_registry}'.format(helm_registry=helm_registry, helm_bin=self.helm_bin), echo=True, policy='registry_login')
+            return 'oci://{helm_registry}/{gcp_project}/{helm_chart}'.format(helm_registry=helm_registry, gcp_project=provider_data['project'], helm_chart=self.config_dict['helm_chart'])
+
+        if add_repo:
+            # Add the Rehive Helm Repo
+            self._run('{helm_bin} repo add rehive https://rehive.github.io/charts'.format(helm_bin=self.helm_bin), echo=True)
+        return self.config_dict['helm_chart']
+
+    def install(self, switch_context=True, helm_chart=None, **kwargs):
+        """
+        Installs kubernetes deployment. `helm_chart` skips resolving the
+        chart when it is already known, see `bootstrap`.
+        """
+        config_dict = self.config_dict
+        target = self._helm_target(switch_context)
+
+        install_flag = ''
+
+        # Prefer the version of the helm binary itself, cached by `doctor`
+        helm_version = tools.tool_version('helm', self.helm_bin) or config_dict.get('helm_version')
+        if helm_version and version.parse(str(helm_version)) <= version.parse('3'):
+            install_flag = " --name"
+
+        helm_chart = helm_chart or self.helm_chart(add_repo=True)
+        helm_values_path, _ = self.values()
+
+        return self._run('{helm_bin} install{helm_install_flag} {project_name}{target} '
+                         '--values {helm_values_path} '
+                         '--version {helm_chart_version} {helm_chart}'
+                         .format(helm_bin=self.helm_bin,
+                                 project_name=config_dict['project_name'],
+                                 target=target,
+                                 helm_install_flag=install_flag,
+                                 helm_values_path=helm_values_path,
+                                 helm_chart=helm_chart,
+                                 helm_chart_version=config_dict['helm_chart_version']),
+                         echo=True, **kwargs)
+
+    def _helm_target(self, switch_context):
+        """
+        Switches to the config's kube context, or when `switch_context` is
+        false returns helm flags that target it without touching the current
+        context, so several configs can be upgraded concurrently.
+        """
+        if switch_context:
+            self.set_context()
+            return ''
+        return ' --kube-context {kube_context} --namespace {namespace}'.format(
+            kube_context=self.kube_context, namespace=self.config_dict['namespace'])
+
+    def values(self):
+        """
+        Returns the path of the config's merged helm values file and the
+        hash of its inputs, see `values.merged_values`.
+        """
+        return merged_values(self.config_dict)
+
+    def _release_key(self):
+        return '{}/{}/{}'.format(self.kube_context, self.config_dict['namespace'],
+                                 self.config_dict['project_name'])
+
+    def is_deployed(self, fingerprint, version):
+        """
+        Checks whether the last upgrade made from here had the same
+        fingerprint and the live deployment still runs `version`.
+        """
+        if cache.load(DEPLOYS_CACHE).get(self._release_key()) != fingerprint:
+            return False
+        try:
+            deployment = kube.read_deployment(self.config_dict['project_name'],
+                                              self.config_dict['namespace'],
+                                              self.kube_context)
+        except ExecuteError:
+            return False
+        image = deployment['spec']['template']['spec']['containers'][0]['image']
+        return image.endswith(':{}'.format(version))
+
+    def _record_deploy(self, fingerprint):
+        with _deploys_lock:
+            deploys = cache.load(DEPLOYS_CACHE)
+            deploys[self._release_key()] = fingerprint
+            cache.save(DEPLOYS_CACHE, deploys)
+
+    def upgrade(self, version, switch_context=True, prepull=False, skip_unchanged=False,
+                on_helm_start=None, **kwargs):
+        """
+        Upgrades kubernetes deployment to the given image tag, first pulling
+        the image onto the deployment's nodes when `prepull` is set.
+        `on_helm_start` is called just before helm runs, i.e. once the
+        release may have changed.
+
+        With `skip_unchanged`, the upgrade is skipped and None returned when
+        the values, tag and chart are unchanged since the last upgrade made
+        from this machine and the deployment still runs the tag. Upgrades
+        made elsewhere, manual changes and republished charts are not
+        detected.
+        """
+        config_dict = self.config_dict
+        helm_values_path, values_hash = self.values()
+        fingerprint = deploy_fingerprint(values_hash, version, config_dict['helm_chart'],
+                                         config_dict['helm_chart_version'])
+        if skip_unchanged and self.is_deployed(fingerprint, version):
+            if self.deployer.echo:
+                print('{} already runs {} with unchanged values, skipping upgrade'
+                      .format(self.name, version))
+            return None
+
+        if prepull:
+            self.prepull(version)
+        target = self._helm_target(switch_context)
+
+        helm_chart = self.helm_chart()
+
+        if on_helm_start:
+            on_helm_start()
+        result = self._run('{helm_bin} upgrade {project_name}{target} '
+                           '--values {helm_values_path} '
+                           '--set image.tag={version} '
+                           '--version {helm_chart_version} {helm_chart}'
+                           .format(helm_bin=self.helm_bin,
+                                   project_name=config_dict['project_name'],
+                                   target=target,
+                                   helm_chart=helm_chart,
+                                   helm_values_path=helm_values_path,
+                                   version=version,
+                                   helm_chart_version=config_dict['helm_chart_version']),
+                           echo=True, **kwargs)
+        self._record_deploy(fingerprint)
+        return result
+
+    def prepull(self, version, timeout=600):
+        """
+        Pulls the deployment's image at the given tag onto every node it can
+        run on, using a short-lived DaemonSet. See `kube.prepull_image`.
+        Returns the image pulled.
+        """
+        deployment = kube.read_deployment(self.config_dict['project_name'],
+                                          self.config_dict['namespace'],
+                                          self.kube_context)
+        # Same tag substitution as the management container
+        image = deployment['spec']['template']['spec']['containers'][0]['image']
+        image = '{}:{}'.format(image.rsplit(':', 1)[0], version)
+        if self.deployer.echo:
+            print('Pre-pulling {}'.format(image))
+        kube.prepull_image(deployment, image, self.kube_context, timeout=timeout)
+        return image
+
+    def rollback(self, switch_context=True, **kwargs):
+        """Rolls the helm release back to its previous revision"""
+        target = self._helm_target(switch_context)
+        result = self._run('{helm_bin} rollback {project_name}{target}'
+                           .format(helm_bin=self.helm_bin,
+                                   project_name=self.config_dict['project_name'],
+                                   target=target),
+                           echo=True, **kwargs)
+        self._record_deploy(None)
+        return result
+
+    def wait_until_ready(self, timeout=600):
+        """Waits for the deployment's rollout to complete, see `kube.wait_for_rollout`"""
+        kube.wait_for_rollout(self.config_dict['project_name'], self.config_dict['namespace'],
+                              self.kube_context, timeout=timeout)
+
+    def _prepare_helm(self):
+        """Installs the local helm if it is missing and resolves the chart"""
+        if not self.config_dict.get('use_system_helm', True) and not os.path.exists(self.helm_bin):
+            self.helm_setup()
+        return self.helm_chart(add_repo=True)
+
+    def bootstrap(self, env_file=None):
+        """
+        Stands up a new namespace in a few calls: the namespace, project
+        secret and image pull secrets are applied as one manifest with a
+        single server-side apply while helm and the chart are prepared,
+        then the release is installed. See `utils.build_bootstrap_manifest`.
+        """
+        manifest = build_bootstrap_manifest(self.config_dict, env_file)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            applied = executor.submit(self.apply, manifest)
+            helm_chart = executor.submit(self._prepare_helm)
+            applied.result()
+            helm_chart = helm_chart.result()
+        return self.install(switch_context=False, helm_chart=helm_chart)
+
+    def apply(self, manifest):
+        """Applies a manifest to the config's cluster with server-side apply"""
+        # The manifest holds secrets, so it is only written to a private
+        # temporary file (invoke cannot close a command's stdin)
+        fd, path = tempfile.mkstemp(suffix='.yaml')
+        try:
+            with os.fdopen(fd, 'w') as stream:
+                stream.write(manifest)
+            return self._run('kubectl apply --server-side --field-manager=rdeploy'
+                             ' --context {kube_context} -f {path}'
+                             .format(kube_context=self.kube_context, path=path),
+                             echo=True)
+        finally:
+            os.remove(path)
+
+    def helm(self, command):
+        self.set_context()
+        return self._run('{helm_bin} {command}'.format(helm_bin=self.helm_bin,
+                                                      command=command),
+                         echo=True)
+
+    def manifest(self, on_document):
+        """
+        Streams the deployed release's manifest, calling `on_document` with
+        each resource as it is read.
+        """
+        self.set_context()
+        return stream_run(self.deployer.ctx,
+                          '{helm_bin} get manifest {project_name}'
+                          .format(helm_bin=self.helm_bin,
+                                  project_name=self.config_dict['project_name']),
+                          YamlDocumentParser(on_document), hide='stdout',
+                          echo=self.deployer.echo)
+
+    def helm_setup(self):
+        """
+        Installs the configured helm version to a local opt directory.
+        Returns the directory it was installed to.
+        """
+        config_dict = self.config_dict
+
+        helm_version = config_dict.get('helm_version')
+        if not helm_version:
+            raise ExecuteError('Please add the helm_version config to rdeploy.yaml.')
+
+        if config_dict.get('use_system_helm', True):
+            raise ExecuteError('Please add the following config to rdeploy.yaml:\n'
+                               'use_system_helm: false')
+
+        if sys.platform == 'linux' or sys.platform == 'linux2':
+            os_string = 'linux-amd64'
+            archive_tool = tarfile
+        elif sys.platform == 'darwin':
+            os_string = 'darwin-amd64'
+            archive_tool = tarfile
+        elif sys.platform == 'win32':
+            os_string = 'windows-amd64'
+            archive_tool = zipfile
+
+        url = 'https://get.helm.sh/helm-v{version}-{os_string}.tar.gz'.format(version=helm_version,
+                                                                              os_string=os_string)
+        file_tmp = urllib.request.urlretrieve(url, filename=None)[0]
+        tar = archive_tool.open(file_tmp)
+        tar.extractall('./opt/helm-v{version}'.format(version=helm_version))
+
+        provider = self.provider_data
+        helm_registry = provider.get('helm_registry')
+        if not (provider.get('name') == 'gcp' and helm_registry):
+            self._run('{helm_bin} repo add stable https://charts.helm.sh/stable'.format(helm_bin=self.helm_bin), echo=True)
+            self._run('{helm_bin} repo add rehive https://rehive.github.io/charts'.format(helm_bin=self.helm_bin), echo=True)
+
+        return 'opt/helm-v{version}/{os_string}/'.format(version=helm_version, os_string=os_string)
+
+    # Deployment
+    ############
+    def live_image(self):
+        """Returns the docker image and version currently deployed"""
+        deployment = kube.read_deployment(self.config_dict['project_name'],
+                                          self.config_dict['namespace'],
+                                          self.kube_context)
+        return deployment['spec']['template']['spec']['containers'][0]['image']
+
+    def status(self, ttl=10):
+        """Returns the deployment status, see `Deployer.status`"""
+        return self.deployer.status([self.name], ttl=ttl)[self.name]
+
+    def logs(self, since_seconds=None, pattern=None, follow=False):
+        """Prints the logs of all pods of the deployment, see `kube.stream_logs`"""
+        kube.stream_logs(self.config_dict['project_name'], self.config_dict['namespace'],
+                         self.kube_context, since_seconds=since_seconds,
+                         pattern=pattern, follow=follow)
+
+    def management_cmd(self, cmd, tag=None):
+        """Returns the kubectl command that runs `cmd` in a management pod"""
+        self.set_context()
+        return build_management_cmd(self.config_dict, cmd, tag)
+
+    def shell(self, tag=None):
+        """Exec into the management container"""
+        return self._run(self.management_cmd('/bin/bash', tag), pty=True, warn=False, echo=True)
+
+    def manage(self, cmd, tag=None):
+        """Runs a Django management command in the management container"""
+        return self._run(self.management_cmd(f'python manage.py {cmd}', tag),
+                         pty=True, warn=False, echo=True)
+
+    # Build commands
+    ################
+    def build(self, tag):
+        """
+        Build project's docker image and pushes to remote repo.
+        Returns the pushed image.
+        """
+        self.set_project()
+        image_name = self.config_dict['docker_image'].split(':')[0]
+        image = '{}:{}'.format(image_name, tag)
+        self._run('docker build -t %s -f etc/docker/Dockerfile .' % image, echo=True)
+        self._run('gcloud auth configure-docker', echo=True)
+        self._run('docker push %s' % image, echo=True)
+        return image
+
+    def cloudbuild(self, tag):
+        """Build project's docker image using a cloud builder and pushes to remote repo"""
+        config_dict = self.config_dict
+        image_name = config_dict['docker_image'].split(':')[0]
+
+        if config_dict.get('container_registry_provider') == 'google':
+            project = config_dict['docker_image'].split('/')[1]
+            self._run('gcloud config set project {project}'
+                      .format(project=project), echo=True)
+        else:
+            self.set_project()
+
+        if self._is_versioned():
+            provider_data = config_dict.get('cloud_provider')
+
+            def azure_image_build(container_registry, image_name, tag):
+                return self._run('az acr run'
+                                 ' -r {container_registry}'
+                                 ' -f ./etc/docker/acr.yaml'
+                                 ' --set IMAGE={image_name}'
+                                 ' --set TAG_NAME={tag_name}'
+                                 ' .'
+                                 .format(container_registry=container_registry,
+                                         image_name=image_name,
+                                         tag_name=tag), echo=True)
+
+            def google_image_build(project, image_name, tag):
+                log_dir = "gs://{project}-cloudbuild-logs/{image}/{tag_name}/".format(
+                    project=project, image=image_name, tag_name=tag)
+                return self._run('gcloud builds submit .'
+                                 ' --config etc/docker/cloudbuild.yaml'
+                                 ' --substitutions _IMAGE={image_name},TAG_NAME={tag_name}'
+                                 ' --gcs-log-dir {log_dir}'
+                                 .format(image_name=image_name, tag_name=tag, log_dir=log_dir),
+                                 echo=True)
+
+            if config_dict.get('container_registry_provider') == 'azure':
+                return azure_image_build(provider_data['container_registry'], image_name, tag)
+
+            elif config_dict.get('container_registry_provider') == 'google':
+                project = config_dict['docker_image'].split('/')[1]
+                return google_image_build(project, image_name, tag)
+
+            else:
+                if provider_data and provider_data['name'] == 'azure':
+                    return azure_image_build(provider_data['container_registry'], image_name, tag)
+                else:
+                    return google_image_build(provider_data['project'], image_name, tag)
+
+        else:
+            log_dir = "gs://{project}-cloudbuild-logs/{image}/{tag_name}/".format(
+                project=config_dict['cloud_project'], image=image_name, tag_name=tag)
+            return self._run('gcloud builds submit .'
+                             ' --config etc/docker/cloudbuild-no-cache.yaml'
+                             ' --substitutions _IMAGE={image_name},TAG_NAME={tag_name}'
+                             ' --gcs-log-dir {log_dir}'
+                             .format(image_name=image_name, tag_name=tag, log_dir=log_dir),
+                             echo=True)
@@ -4,3 +4,10 @@ class ReleaseError(BaseException):
 
 class ExecuteError(BaseException):
     pass
+
+
+class CommandTimeout(ExecuteError):
+    def __init__(self, command, timeout):
+        super().__init__(f'Command timed out after {timeout}s: {command}')
+        self.command = command
+        self.timeout = timeout
@@ -0,0 +1,516 @@
+"""
+Shared Kubernetes API clients.
+
+Clients are built lazily, one per kube context, and reused for the lifetime
+of the process so that repeated calls share urllib3 connection pools and
+auth tokens. A client is rebuilt when the kubeconfig file changes.
+"""
+import json
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from rdeploy.exceptions import ExecuteError
+
+
+# Kube context -> (kubeconfig key, ApiClient)
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_kube_config_file():
+    """Returns the kubeconfig path(s), honouring $KUBECONFIG"""
+    paths = os.environ.get('KUBECONFIG') or '~/.kube/config'
+    return os.pathsep.join(os.path.expanduser(p) for p in paths.split(os.pathsep) if p)
+
+
+def _kube_config_key(config_file):
+    key = []
+    for path in config_file.split(os.pathsep):
+        try:
+            key.append((path, os.stat(path).st_mtime_ns))
+        except FileNotFoundError:
+            key.append((path, None))
+    return tuple(key)
+
+
+def _new_api_client(config_file, context):
+    from kubernetes import client, config
+    from kubernetes.config.config_exception import ConfigException
+    from kubernetes.config.kube_config import KubeConfigLoader, KubeConfigMerger
+
+    configuration = client.Configuration()
+    config.load_kube_config(config_file=config_file, context=context,
+                            client_configuration=configuration)
+
+    # Workaround to read the proxy-url as it is not currently read by load_kube_config()
+    # TODO: submit as pull request to kubernetes python
+    try:
+        loader = KubeConfigLoader(config_dict=KubeConfigMerger(config_file).config,
+                                  active_context=context)
+        proxy_url = loader._cluster['proxy-url']
+    except ConfigException:
+        proxy_url = None
+
+    if proxy_url is not None:
+        configuration.proxy = proxy_url
+
+    return client.ApiClient(configuration)
+
+
+def _parse_rfc3339(timestamp):
+    # Trim sub-second precision to what datetime can parse
+    timestamp = re.sub(r'(\.\d{6})\d+', r'\1', timestamp.replace('Z', '+00:00'))
+    return datetime.fromisoformat(timestamp)
+
+
+def has_fresh_credentials(context, margin=60):
+    """
+    Checks the kubeconfig for a context whose cluster and user are defined
+    and whose cached token, if it has an expiry, is valid for at least
+    `margin` more seconds. Exec credential plugins and static credentials
+    are considered fresh since they are not refreshed by get-credentials.
+    """
+    import yaml
+
+    contexts, clusters, users = {}, {}, {}
+    for path in get_kube_config_file().split(os.pathsep):
+        try:
+            with open(path, 'r') as stream:
+                kube_config = yaml.safe_load(stream) or {}
+        except FileNotFoundError:
+            continue
+        # As with kubectl, the first file to define a name wins
+        for items, entries in ((contexts, 'contexts'), (clusters, 'clusters'), (users, 'users')):
+            for entry in kube_config.get(entries) or []:
+                items.setdefault(entry['name'], entry)
+
+    context_entry = contexts.get(context)
+    if not context_entry:
+        return False
+    cluster = clusters.get(context_entry['context'].get('cluster'))
+    user = users.get(context_entry['context'].get('user'))
+    if not cluster or not cluster['cluster'].get('server') or not user:
+        return False
+
+    user = user.get('user') or {}
+    expiry = ((user.get('auth-provider') or {}).get('config') or {}).get('expiry')
+    if expiry:
+        remaining = _parse_rfc3339(expiry) - datetime.now(timezone.utc)
+        return remaining.total_seconds() > margin
+    return bool(user)
+
+
+def get_api_client(context=None):
+    """
+    Returns the shared ApiClient for a kube context. The current context is
+    used when none is given. When the kubeconfig has changed since the client
+    was built, it is replaced and the old client's connections are closed.
+    """
+    config_file = get_kube_config_file()
+    config_key = _kube_config_key(config_file)
+    with _clients_lock:
+        cached_key, api_client = _clients.get(context, (None, None))
+        if api_client is not None and cached_key == config_key:
+            return api_client
+        stale_client = api_client
+        api_client = _new_api_client(config_file, context)
+        _clients[context] = (config_key, api_client)
+    if stale_client is not None:
+        _close_api_client(stale_client)
+    return api_client
+
+
+def _close_api_client(api_client):
+    # Requests still in flight finish, their connections are not reused
+    api_client.close()
+    api_client.rest_client.pool_manager.clear()
+
+
+def apps_v1_api(context=None):
+    from kubernetes import client
+    return client.AppsV1Api(get_api_client(context))
+
+
+def core_v1_api(context=None):
+    from kubernetes import client
+    return client.CoreV1Api(get_api_client(context))
+
+
+def _read_raw(read, kind, name, namespace):
+    """
+    Calls a read_namespaced_* method and returns the decoded JSON body,
+    skipping the client's model deserialization.
+    """
+    from kubernetes.client.rest import ApiException
+
+    try:
+        response = read(name, namespace, _preload_content=False)
+    except ApiException as e:
+        if e.status == 404:
+            raise ExecuteError(f'{kind} {name} not found in namespace {namespace}')
+        raise ExecuteError(f'Failed to read {kind} {name}: {e.reason}')
+    return json.loads(response.data)
+
+
+def read_deployment(name, namespace, context=None):
+    """Returns a deployment as a plain dict"""
+    return _read_raw(apps_v1_api(context).read_namespaced_deployment,
+                     'Deployment', name, namespace)
+
+
+def read_secret(name, namespace, context=None):
+    """Returns a secret as a plain dict"""
+    return _read_raw(core_v1_api(context).read_namespaced_secret,
+                     'Secret', name, namespace)
+
+
+def _parse_time(timestamp):
+    return datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+
+
+def deployment_status(deployment, helm_chart=None):
+    """
+    Summarises a deployment dict: image, tag, helm chart version, ready and
+    desired replicas and the seconds since the last rollout.
+    """
+    metadata = deployment['metadata']
+    image = deployment['spec']['template']['spec']['containers'][0]['image']
+    image_name, _, tag = image.rpartition(':')
+    if '/' in tag or not image_name:
+        image_name, tag = image, ''
+
+    # Helm labels deployments with <chart name>-<chart version>
+    chart_label = (metadata.get('labels') or {}).get('helm.sh/chart') \
+        or (metadata.get('labels') or {}).get('chart', '')
+    chart_name = helm_chart.split('/')[-1] if helm_chart else ''
+    if chart_name and chart_label.startswith(chart_name + '-'):
+        chart_version = chart_label[len(chart_name) + 1:]
+    else:
+        chart_version = chart_label.rpartition('-')[2]
+
+    status = deployment.get('status') or {}
+    rollout_time = metadata['creationTimestamp']
+    for condition in status.get('conditions') or []:
+        if condition['type'] == 'Progressing' and condition.get('lastUpdateTime'):
+            rollout_time = condition['lastUpdateTime']
+    rollout_age = (datetime.now(timezone.utc) - _parse_time(rollout_time)).total_seconds()
+
+    return {
+        'image': image_name,
+        'tag': tag,
+        'chart_version': chart_version,
+        'ready_replicas': status.get('readyReplicas', 0),
+        'desired_replicas': deployment['spec'].get('replicas', 0),
+        'rollout_age': int(rollout_age),
+    }
+
+
+def _rollout_progress(deployment):
+    """
+    Returns None once a deployment's latest generation is fully rolled out,
+    otherwise a description of what it is waiting for, as
+    `kubectl rollout status` does.
+    """
+    metadata = deployment['metadata']
+    status = deployment.get('status') or {}
+    replicas = deployment['spec'].get('replicas', 1)
+
+    if status.get('observedGeneration', 0) < metadata.get('generation', 0):
+        return 'waiting for the deployment spec update to be observed'
+    for condition in status.get('conditions') or []:
+        if condition['type'] == 'Progressing' and condition.get('reason') == 'ProgressDeadlineExceeded':
+            raise ExecuteError(f"Deployment {metadata['name']} exceeded its progress deadline")
+    updated = status.get('updatedReplicas', 0)
+    if updated < replicas:
+        return f'{updated} of {replicas} updated replicas'
+    if status.get('replicas', 0) > updated:
+        return f"{status['replicas'] - updated} old replicas pending termination"
+    if status.get('availableReplicas', 0) < updated:
+        return f"{status.get('availableReplicas', 0)} of {updated} updated replicas available"
+    return None
+
+
+def wait_for_rollout(name, namespace, context=None, timeout=600):
+    """
+    Blocks until a deployment's latest generation is fully rolled out,
+    watching it rather than polling. Raises ExecuteError if the rollout
+    exceeds its progress deadline or `timeout` seconds pass.
+    """
+    from kubernetes import watch
+
+    apps_v1 = apps_v1_api(context)
+    deadline = time.monotonic() + timeout
+    deployment = read_deployment(name, namespace, context)
+    progress = _rollout_progress(deployment)
+    resource_version = deployment['metadata']['resourceVersion']
+
+    while progress is not None:
+        remaining = int(deadline - time.monotonic())
+        if remaining <= 0:
+            raise ExecuteError(f'Timed out waiting for deployment {name} rollout: {progress}')
+        deployment_watch = watch.Watch()
+        for event in deployment_watch.stream(apps_v1.list_namespaced_deployment, namespace,
+                                             field_selector=f'metadata.name={name}',
+                                             resource_version=resource_version,
+                                             timeout_seconds=remaining):
+            if event['type'] == 'DELETED':
+                raise ExecuteError(f'Deployment {name} was deleted during its rollout')
+            deployment = event['raw_object']
+            progress = _rollout_progress(deployment)
+            if progress is None:
+                deployment_watch.stop()
+                break
+        resource_version = deployment_watch.resource_version or resource_version
+
+
+PREPULL_LABEL = 'rdeploy.io/prepull'
+PAUSE_IMAGE = 'registry.k8s.io/pause:3.9'
+IMAGE_PULL_ERRORS = ('ErrImagePull', 'ImagePullBackOff', 'InvalidImageName', 'ErrImageNeverPull')
+
+
+def prepull_daemon_set(deployment, image):
+    """
+    Returns a DaemonSet that pulls `image` onto every node the deployment's
+    pods can be scheduled on. The image is pulled by an init container with
+    the deployment's pull secrets, service account, node selector, node
+    affinity and tolerations, after which the pod idles on the pause image.
+    """
+    name = deployment['metadata']['name']
+    pod_spec = deployment['spec']['template']['spec']
+    labels = {PREPULL_LABEL: name}
+
+    spec = {
+        'initContainers': [{
+            'name': 'prepull',
+            'image': image,
+            'imagePullPolicy': 'IfNotPresent',
+            # Only the pull matters, images without a shell fail harmlessly
+            'command': ['sh', '-c', 'exit 0'],
+            'resources': {'requests': {'cpu': '1m', 'memory': '8Mi'}},
+        }],
+        'containers': [{
+            'name': 'pause',
+            'image': PAUSE_IMAGE,
+            'resources': {'requests': {'cpu': '1m', 'memory': '8Mi'}},
+        }],
+        'terminationGracePeriodSeconds': 0,
+    }
+    for key in ('imagePullSecrets', 'serviceAccountName', 'nodeSelector', 'tolerations'):
+        if pod_spec.get(key):
+            spec[key] = pod_spec[key]
+    # Pod (anti-)affinity refers to the app's own pods and would keep the
+    # prepull pods off the very nodes that run it, only node affinity applies
+    node_affinity = (pod_spec.get('affinity') or {}).get('nodeAffinity')
+    if node_affinity:
+        spec['affinity'] = {'nodeAffinity': node_affinity}
+
+    return {
+        'apiVersion': 'apps/v1',
+        'kind': 'DaemonSet',
+        'metadata': {'name': f'{name}-prepull', 'labels': labels},
+        'spec': {
+            'selector': {'matchLabels': labels},
+            'template': {'metadata': {'labels': labels}, 'spec': spec},
+        },
+    }
+
+
+def _pulled_pods(pods, image, owner_uid):
+    """
+    Counts the pods of the DaemonSet with uid `owner_uid` whose prepull init
+    container has pulled `image`, raising ExecuteError if a node cannot pull
+    it. Pods that are being deleted, belong to an earlier DaemonSet or were
+    created for another image are ignored.
+    """
+    pulled = 0
+    for pod in pods:
+        metadata = pod.get('metadata') or {}
+        if metadata.get('deletionTimestamp'):
+            continue
+        owners = metadata.get('ownerReferences') or []
+        if not any(owner.get('uid') == owner_uid for owner in owners):
+            continue
+        init_containers = (pod.get('spec') or {}).get('initContainers') or []
+        if not any(c['name'] == 'prepull' and c.get('image') == image for c in init_containers):
+            continue
+        for container in (pod.get('status') or {}).get('initContainerStatuses') or []:
+            if container['name'] != 'prepull':
+                continue
+            waiting = (container.get('state') or {}).get('waiting') or {}
+            if waiting.get('reason') in IMAGE_PULL_ERRORS:
+                raise ExecuteError(f"Failed to pull {image}: "
+                                   f"{waiting.get('message') or waiting['reason']}")
+            if container.get('imageID'):
+                pulled += 1
+    return pulled
+
+
+def prepull_image(deployment, image, context=None, timeout=600):
+    """
+    Pulls `image` onto the nodes of a deployment, see `prepull_daemon_set`,
+    and blocks until every node has it. The DaemonSet is always deleted
+    afterwards. Raises ExecuteError on pull errors or after `timeout` seconds.
+    """
+    from kubernetes import watch
+    from kubernetes.client.rest import ApiException
+
+    apps_v1 = apps_v1_api(context)
+    core_v1 = core_v1_api(context)
+    namespace = deployment['metadata']['namespace']
+    body = prepull_daemon_set(deployment, image)
+    name = body['metadata']['name']
+    label_selector = _label_selector(body)
+    deadline = time.monotonic() + timeout
+
+    try:
+        daemon_set = apps_v1.create_namespaced_daemon_set(namespace, body)
+    except ApiException as e:
+        if e.status != 409:
+            raise ExecuteError(f'Failed to create DaemonSet {name}: {e.reason}')
+        # Left over from an interrupted prepull
+        daemon_set = apps_v1.replace_namespaced_daemon_set(name, namespace, body)
+    owner_uid = daemon_set.metadata.uid
+
+    try:
+        while True:
+            daemon_set = _read_raw(apps_v1.read_namespaced_daemon_set, 'DaemonSet', name, namespace)
+            response = core_v1.list_namespaced_pod(namespace, label_selector=label_selector,
+                                                   _preload_content=False)
+            pod_list = json.loads(response.data)
+            pulled = _pulled_pods(pod_list['items'], image, owner_uid)
+
+            status = daemon_set.get('status') or {}
+            scheduled = status.get('observedGeneration', 0) >= daemon_set['metadata'].get('generation', 1)
+            desired = status.get('desiredNumberScheduled', 0)
+            if scheduled and pulled >= desired:
+                return pulled
+
+            remaining = int(deadline - time.monotonic())
+            if remaining <= 0:
+                raise ExecuteError(f'Timed out pulling {image}: {pulled} of {desired} nodes done')
+            # Wait for the next pod change, re-reading the DaemonSet every few seconds
+            pod_watch = watch.Watch()
+            for _ in pod_watch.stream(core_v1.list_namespaced_pod, namespace,
+                                      label_selector=label_selector,
+                                      resource_version=pod_list['metadata']['resourceVersion'],
+                                      timeout_seconds=min(remaining, 5)):
+                pod_watch.stop()
+    finally:
+        try:
+            apps_v1.delete_namespaced_daemon_set(name, namespace, propagation_policy='Background')
+        except ApiException as e:
+            if e.status != 404:
+                print(f'Failed to delete DaemonSet {name}: {e.reason}', file=sys.stderr)
+
+
+def _label_selector(deployment):
+    match_labels = deployment['spec']['selector'].get('matchLabels') or {}
+    return ','.join(f'{k}={v}' for k, v in sorted(match_labels.items()))
+
+
+def stream_logs(name, namespace, context=None, since_seconds=None, pattern=None,
+                follow=False, buffer_lines=1000):
+    """
+    Prints the logs of every pod of a deployment, each line prefixed with the
+    pod name.
+
+    Pods are streamed concurrently, one reader thread per pod. Each reader
+    may hold at most `buffer_lines` unprinted lines; beyond that it stops
+    reading until the printer catches up, so memory stays flat however much
+    a pod logs. When following, pods that start during a rollout are picked
+    up as well. `pattern` is a compiled regex matched against each line
+    before it is buffered.
+    """
+    from kubernetes import watch
+
+    core_v1 = core_v1_api(context)
+    deployment = read_deployment(name, namespace, context)
+    container = deployment['spec']['template']['spec']['containers'][0]['name']
+    label_selector = _label_selector(deployment)
+
+    lines = queue.Queue()
+    # Pods whose log has been read, never cleared so that a pod whose stream
+    # ended is not read again from the start on its next MODIFIED event
+    seen = set()
+    readers = []
+    lock = threading.Lock()
+
+    def read_pod(pod_name):
+        slots = threading.BoundedSemaphore(buffer_lines)
+        try:
+            response = core_v1.read_namespaced_pod_log(
+                pod_name, namespace, container=container, follow=follow,
+                since_seconds=since_seconds, _preload_content=False)
+            for line in response:
+                line = line.decode('utf-8', errors='replace').rstrip('\n')
+                if pattern is None or pattern.search(line):
+                    slots.acquire()
+                    lines.put((slots, f'[{pod_name}] {line}'))
+        except Exception as e:
+            lines.put((None, f'[{pod_name}] error reading logs: {e}'))
+
+    def start(pod_name):
+        with lock:
+            if pod_name in seen:
+                return
+            seen.add(pod_name)
+        reader = threading.Thread(target=read_pod, args=(pod_name,), daemon=True)
+        readers.append(reader)
+        reader.start()
+
+    def is_running(pod):
+        return pod['status'].get('phase') in ('Running', 'Succeeded', 'Failed')
+
+    def start_running_pods():
+        """Starts readers for the running pods, returns the list's resourceVersion"""
+        response = core_v1.list_namespaced_pod(namespace, label_selector=label_selector,
+                                               _preload_content=False)
+        pod_list = json.loads(response.data)
+        for pod in pod_list['items']:
+            if is_running(pod):
+                start(pod['metadata']['name'])
+        return pod_list['metadata']['resourceVersion']
+
+    resource_version = start_running_pods()
+
+    def watch_pods(resource_version):
+        pod_watch = watch.Watch()
+        while True:
+            try:
+                for event in pod_watch.stream(core_v1.list_namespaced_pod, namespace,
+                                              label_selector=label_selector,
+                                              resource_version=resource_version):
+                    pod = event['raw_object']
+                    if event['type'] in ('ADDED', 'MODIFIED') and \
+                            pod['status'].get('phase') == 'Running':
+                        start(pod['metadata']['name'])
+                resource_version = pod_watch.resource_version or start_running_pods()
+            except Exception as e:
+                # E.g. 410 Gone once the resource version is compacted away:
+                # list again, picking up pods started meanwhile, and resume
+                if getattr(e, 'status', None) != 410:
+                    time.sleep(1)
+                try:
+                    resource_version = start_running_pods()
+                except Exception:
+                    time.sleep(1)
+
+    if follow:
+        threading.Thread(target=watch_pods, args=(resource_version,), daemon=True).start()
+
+    while True:
+        try:
+            slots, line = lines.get(timeout=0.5)
+        except queue.Empty:
+            if not follow and lines.empty() and not any(reader.is_alive() for reader in readers):
+                break
+            continue
+        print(line)
+        if slots is not None:
+            slots.release()
+    sys.stdout.flush()
@@ -1,7 +1,7 @@
 import pkg_resources
 from invoke import Argument, Collection, Program
 
-import rdeploy
+from rdeploy import tasks
 
 
 class MainProgram(Program):
@@ -14,4 +14,4 @@ class MainProgram(Program):
 
 
 version = pkg_resources.get_distribution("rdeploy").version
-program = MainProgram(namespace=Collection.from_module(rdeploy), version=version)
+program = MainProgram(namespace=Collection.from_module(tasks), version=version)
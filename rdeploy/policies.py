@@ -0,0 +1,255 @@
+"""
+Timeouts, retries and hedging for flaky network-bound commands.
+
+Commands are grouped into classes (e.g. `credentials` for
+`gcloud container clusters get-credentials`). Each class has a default
+policy which can be overridden in rdeploy.yaml:
+
+    command_policies:
+      credentials:
+        timeout: 60        # seconds before the command is terminated
+        retries: 2         # attempts after the first one
+        backoff: 2         # seconds before the first retry, doubled each time
+        retry_exit_codes: [1]  # also retry these exit codes, not only timeouts
+
+Only timeouts are retried by default, since most non-zero exit codes are
+deterministic failures. Commands are stopped with SIGTERM, and only killed
+if they are still running `KILL_GRACE` seconds later, so tools can remove
+their lock files. Commands run in their own session, so a Ctrl-C is
+forwarded to them and stops the command without any retry.
+
+`hedge_after` starts a second copy of a command that is still running after
+that many seconds. It is off for every class and should only be enabled for
+commands that are safe to run twice at once, i.e. reads that write nothing.
+"""
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from subprocess import PIPE, Popen
+
+from invoke.exceptions import UnexpectedExit
+from invoke.runners import Local, normalize_hide
+
+from rdeploy.exceptions import CommandTimeout
+
+
+KILL_GRACE = 5
+
+DEFAULT_POLICIES = {
+    'default': {'timeout': None, 'retries': 0, 'backoff': 1, 'retry_exit_codes': [],
+                'hedge_after': None},
+    'credentials': {'timeout': 120, 'retries': 2, 'backoff': 2},
+    'registry_login': {'timeout': 60, 'retries': 2, 'backoff': 2},
+    'git_fetch': {'timeout': 60, 'retries': 2, 'backoff': 1},
+}
+
+
+def get_policy(settings_dict, name):
+    """Returns the policy of a command class, merging rdeploy.yaml overrides"""
+    policy = dict(DEFAULT_POLICIES['default'])
+    policy.update(DEFAULT_POLICIES.get(name, {}))
+    policy.update((settings_dict.get('command_policies') or {}).get(name) or {})
+    return policy
+
+
+class TimeoutRunner(Local):
+    """
+    Local runner that stops the command, and anything it spawned, once
+    `timeout` seconds have passed.
+    """
+
+    def __init__(self, context, timeout=None, kill_grace=KILL_GRACE):
+        super().__init__(context)
+        self.timeout = timeout
+        self.kill_grace = kill_grace
+        self.timed_out = False
+        self.interrupted = False
+        self._timer = None
+        self._pid = None
+        self._killed = False
+        self._lock = threading.Lock()
+
+    def start(self, command, shell, env):
+        with self._lock:
+            if self.using_pty:
+                super().start(command, shell, env)
+                self._pid = self.pid
+            else:
+                # Run in a new session so the whole pipeline can be stopped
+                self.process = Popen(
+                    command,
+                    shell=True,
+                    executable=shell,
+                    env=env,
+                    stdout=PIPE,
+                    stderr=PIPE,
+                    stdin=PIPE,
+                    start_new_session=True,
+                )
+                self._pid = self.process.pid
+            killed = self._killed
+        if killed:
+            # kill() was called before the command started
+            threading.Thread(target=self._terminate, args=(self._pid,), daemon=True).start()
+        if self.timeout:
+            self._timer = threading.Timer(self.timeout, self.expire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def kill(self):
+        """
+        Sends SIGTERM to the command's process group and SIGKILL if it is
+        still running `kill_grace` seconds later. When the command has not
+        started yet, it is stopped as soon as it does.
+        """
+        with self._lock:
+            self._killed = True
+            pid = self._pid
+        if pid is not None:
+            self._terminate(pid)
+
+    def _terminate(self, pid):
+        if not hasattr(os, 'killpg'):
+            # No process groups on Windows
+            self.process.kill()
+            return
+        try:
+            os.killpg(pid, signal.SIGTERM)
+            deadline = time.monotonic() + self.kill_grace
+            while time.monotonic() < deadline:
+                time.sleep(0.1)
+                # Raises once every process of the group has exited
+                os.killpg(pid, 0)
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def send_interrupt(self, interrupt):
+        # The command is in its own session and does not get the terminal's
+        # SIGINT, so pass it on to the whole process group
+        self.interrupted = True
+        if not hasattr(os, 'killpg') or self._pid is None:
+            super().send_interrupt(interrupt)
+            return
+        try:
+            os.killpg(self._pid, signal.SIGINT)
+        except ProcessLookupError:
+            pass
+
+    def expire(self):
+        self.timed_out = True
+        self.kill()
+
+    def stop(self):
+        if self._timer:
+            self._timer.cancel()
+        super().stop()
+
+    def run(self, command, **kwargs):
+        try:
+            result = super().run(command, **kwargs)
+        except UnexpectedExit:
+            if self.interrupted:
+                raise KeyboardInterrupt
+            if self.timed_out:
+                raise CommandTimeout(command, self.timeout)
+            raise
+        if self.timed_out:
+            raise CommandTimeout(command, self.timeout)
+        return result
+
+
+def _describe(error):
+    if isinstance(error, CommandTimeout):
+        return 'Timed out after {}s'.format(error.timeout)
+    return 'Exited with {}'.format(error.result.exited)
+
+
+def _hedged_run(ctx, command, policy, **kwargs):
+    """
+    Runs a command and, if it has not finished after `hedge_after` seconds,
+    a second copy of it. The first copy to succeed wins and the other is
+    killed. Output is replayed once the winner is known.
+    """
+    hide = normalize_hide(kwargs.get('hide'))
+    if kwargs.pop('echo', False) and hide != ('stdout', 'stderr'):
+        print("\033[1;37m{0}\033[0m".format(command))
+    kwargs['hide'] = True
+
+    outcomes = queue.Queue()
+    runners = []
+
+    def attempt(runner):
+        try:
+            outcomes.put((runner, runner.run(command, **kwargs), None))
+        except (CommandTimeout, UnexpectedExit, KeyboardInterrupt) as e:
+            outcomes.put((runner, None, e))
+
+    def start():
+        # Registered before it runs so that it is always stopped if it loses
+        runner = TimeoutRunner(ctx, policy['timeout'])
+        runners.append(runner)
+        threading.Thread(target=attempt, args=(runner,), daemon=True).start()
+
+    start()
+    try:
+        try:
+            winner, result, error = outcomes.get(timeout=policy['hedge_after'])
+        except queue.Empty:
+            print('No result after {}s, hedging: {}'.format(policy['hedge_after'], command),
+                  file=sys.stderr)
+            start()
+            winner, result, error = outcomes.get()
+            if error is not None:
+                winner, result, error = outcomes.get()
+    except KeyboardInterrupt as e:
+        # The copies run in their own sessions and did not get the SIGINT
+        for runner in runners:
+            runner.send_interrupt(e)
+        raise
+
+    for runner in runners:
+        if runner is not winner:
+            threading.Thread(target=runner.kill, daemon=True).start()
+
+    if error is not None:
+        raise error
+    if 'stdout' not in hide:
+        sys.stdout.write(result.stdout)
+    if 'stderr' not in hide:
+        sys.stderr.write(result.stderr)
+    return result
+
+
+def run_with_policy(ctx, command, policy, **kwargs):
+    """
+    Runs a command like `ctx.run`, applying a policy's timeout, retries with
+    exponential backoff and hedging. Timeouts and the policy's
+    `retry_exit_codes` are retried, other failures and KeyboardInterrupt are
+    raised straight away.
+    Each retry is reported on stderr and the returned Result records the
+    number of `attempts` made.
+    """
+    attempts = policy['retries'] + 1
+    for attempt in range(1, attempts + 1):
+        try:
+            if policy['hedge_after']:
+                result = _hedged_run(ctx, command, policy, **kwargs)
+            else:
+                result = TimeoutRunner(ctx, policy['timeout']).run(command, **kwargs)
+        except (CommandTimeout, UnexpectedExit) as e:
+            retryable = isinstance(e, CommandTimeout) \
+                or e.result.exited in policy['retry_exit_codes']
+            if attempt == attempts or not retryable:
+                raise
+            delay = policy['backoff'] * 2 ** (attempt - 1)
+            print('{}, retrying in {}s (attempt {}/{}): {}'
+                  .format(_describe(e), delay, attempt + 1, attempts, command),
+                  file=sys.stderr)
+            time.sleep(delay)
+        else:
+            result.attempts = attempt
+            return result
@@ -0,0 +1,87 @@
+"""
+Streaming command output.
+
+`ctx.run` keeps a command's whole output in memory to build its Result.
+`stream_run` instead hands stdout to a parser chunk by chunk as it arrives,
+so large outputs (release manifests, long listings) are processed with
+bounded memory and the first results are available before the command
+finishes.
+"""
+import yaml
+from invoke.runners import Local
+
+
+class StreamingRunner(Local):
+    """Local runner that feeds stdout to a parser instead of capturing it"""
+
+    def __init__(self, context, parser):
+        super().__init__(context)
+        self.parser = parser
+
+    def handle_stdout(self, buffer_, hide, output):
+        for data in self.read_proc_output(self.read_proc_stdout):
+            if not hide:
+                self.write_our_output(stream=output, string=data)
+            self.parser.feed(data)
+
+
+def stream_run(ctx, command, parser, **kwargs):
+    """
+    Runs a command like `ctx.run`, feeding its stdout to `parser`.
+    The returned Result has an empty stdout. Watchers are not supported
+    since they would need the output buffered.
+    """
+    if kwargs.get('watchers'):
+        raise ValueError('stream_run does not support watchers')
+    try:
+        return StreamingRunner(ctx, parser).run(command, **kwargs)
+    finally:
+        parser.close()
+
+
+class LineParser:
+    """Calls `on_line` with each complete line of output, without the newline"""
+
+    def __init__(self, on_line):
+        self.on_line = on_line
+        self._partial = ''
+
+    def feed(self, data):
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self.on_line(line)
+
+    def close(self):
+        if self._partial:
+            self.on_line(self._partial)
+            self._partial = ''
+
+
+class YamlDocumentParser(LineParser):
+    """
+    Calls `on_document` with each document of a multi-document YAML stream
+    as soon as its closing `---` is read. Empty documents are skipped.
+    """
+
+    def __init__(self, on_document):
+        super().__init__(self._on_line)
+        self.on_document = on_document
+        self._lines = []
+
+    def _on_line(self, line):
+        if line.startswith('---'):
+            self._emit()
+        else:
+            self._lines.append(line)
+
+    def _emit(self):
+        document = yaml.safe_load('\n'.join(self._lines)) if self._lines else None
+        self._lines = []
+        if document is not None:
+            self.on_document(document)
+
+    def close(self):
+        super().close()
+        self._emit()
+
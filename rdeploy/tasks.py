@@ -1,186 +1,74 @@
 import sys
-import tarfile
-import zipfile
-import urllib.request
-import io
+import re
 
+import yaml
 from invoke import task
-import semver
-import json
-import re
 
-from packaging import version
-from rdeploy.exceptions import ReleaseError
+from rdeploy import daemon
+from rdeploy.deployer import Deployer
+from rdeploy.exceptions import ExecuteError
+
+from rdeploy.utils import format_age, parse_duration, confirm
+
+
+def get_deployer(ctx):
+    """Returns a Deployer running commands through the task's context"""
+    return Deployer(ctx=ctx, echo=True)
 
-from rdeploy.utils import get_settings, confirm, get_helm_bin, yaml_decode_data_fields, build_management_cmd
 
 # Cluster Activation:
 #####################
 @task
 def set_project(ctx, config):
     """Sets the active gcloud project"""
-    settings_dict = get_settings()
-    config_dict = settings_dict['configs'][config]
-    if settings_dict.get('version') and version.parse(str(settings_dict['version'])) > version.parse('1'):
-        provider_data = config_dict.get('cloud_provider')
-        if provider_data and provider_data['name'] == 'azure':
-            ctx.run('az account set -s {subscription}'
-                .format(subscription=provider_data['subscription_id']), echo=True)
-        elif provider_data and provider_data['name'] == 'gcp':
-            ctx.run('gcloud config set project {project}'
-                .format(project=provider_data['project']), echo=True)
-    else:
-        ctx.run('gcloud config set project {project}'
-                .format(project=config_dict['cloud_project']), echo=True)
+    get_deployer(ctx).config(config).set_project()
 
-@task
-def set_cluster(ctx, config):
-    """Sets the active cluster"""
-    settings_dict = get_settings()
-    config_dict = settings_dict['configs'][config]
-
-    if settings_dict.get('version') and version.parse(str(settings_dict['version'])) > version.parse('1'):
-        provider_data = config_dict.get('cloud_provider')
-        if provider_data['name'] == 'azure':
-            ctx.run('az aks get-credentials -g {group} -n {cluster} --context aks-{region}-{cluster} --context {name}_{cluster}_{region}  --overwrite-existing'
-                    .format(group=provider_data['resource_group'],
-                            cluster=provider_data['kube_cluster'],
-                            region=provider_data['region'],
-                            name=provider_data['name']
-                            ), echo=True)
-        elif provider_data['name'] == 'gcp':
-            if provider_data.get('zone'):
-                zone_or_region_param = '--zone {}'.format(provider_data['zone'])
-                zone = provider_data['zone']
-            elif provider_data.get('region'):
-                zone_or_region_param = '--region {}'.format(provider_data['region'])
-                zone = provider_data['region']
-
-            ctx.run('gcloud container clusters get-credentials {cluster}'
-                    ' --project {project} {zone_or_region_param}'
-                    .format(cluster=provider_data['kube_cluster'],
-                            project=provider_data['project'],
-                            zone_or_region_param=zone_or_region_param),
-                    echo=True)
-
-            ctx.run('kubectl config rename-context gke_{project}_{zone}_{cluster}'
-                    ' {name}_{project}_{cluster}_{zone}'
-                    .format(cluster=provider_data['kube_cluster'],
-                            project=provider_data['project'],
-                            name=provider_data['name'],
-                            zone=zone),
-                    echo=True)
-        else:
-            sys.exit(f"Unsupported provider: {provider_data['name']}")
-    else:
-        if config_dict.get('cloud_zone'):
-            zone_or_region_param = '--zone {}'.format(config_dict['cloud_zone'])
-            zone = config_dict['cloud_zone']
-        elif config_dict.get('cloud_region'):
-            zone_or_region_param = '--region {}'.format(config_dict['cloud_region'])
-            zone = config_dict['cloud_region']
-        else:
-            zone_or_region_param = '--zone europe-west1-c'
-            zone = 'europe-west1-c'
-
-        ctx.run('gcloud container clusters get-credentials {cluster}'
-                ' --project {project} {zone_or_region_param}'
-                .format(cluster=config_dict['cluster'],
-                        project=config_dict['cloud_project'],
-                        zone_or_region_param=zone_or_region_param),
-                echo=True)
-
-        ctx.run('kubectl config rename-context gke_{project}_{zone}_{cluster}'
-                ' gcp_{project}_{cluster}_{zone}'
-                .format(cluster=config_dict['cluster'],
-                        project=config_dict['cloud_project'],
-                        zone=zone),
-                echo=True)
-
-
-@task()
-def activate(ctx, config):
+
+@task(help={'force': 'Always fetch credentials from the cloud provider'})
+def set_cluster(ctx, config, force=False):
+    """
+    Sets the active cluster
+    Credentials are only fetched when the kube context is missing or its
+    credentials have expired, unless --force is given
+    """
+    handle = get_deployer(ctx).config(config)
+    if not handle.set_cluster(force=force):
+        print('Credentials for {} are present and valid, use --force to refresh them.'
+              .format(handle.kube_context))
+
+
+@task(help={'force': 'Always fetch credentials from the cloud provider'})
+def activate(ctx, config, force=False):
     """Fetches and sets the project, cluster and namespace"""
-    settings_dict = get_settings()
-    config_dict = settings_dict['configs'][config]
-    set_project(ctx, config)
-    set_cluster(ctx, config)
-    ctx.run('kubectl config use-context $(kubectl config current-context)'
-            ' --namespace={namespace}'
-            .format(namespace=config_dict['namespace']),
-            echo=True)
+    get_deployer(ctx).config(config).activate(force=force)
 
 
 @task(aliases=['set-context'])
 def set_context(ctx, config):
     """Switch cluster and namespace"""
-    settings_dict = get_settings()
-    config_dict = settings_dict['configs'][config]
-    provider_data = config_dict.get('cloud_provider')
-
-    # Check for future versions
-    if settings_dict.get('version') and version.parse(str(settings_dict['version'])) > version.parse('3'):
-        sys.exit(f"Unsupported rdeploy.yaml version, please upgrade rdeploy or double check the version number.")
-
-    # v3 of the config file uses the kube_context value to set the kubernetes cluster context
-    # whereas previous versions used the GCP/AZ tools to set it and a naming convention        
-    elif str(settings_dict.get('version')) == '3' and config_dict.get('kube_context'):
-        ctx.run('kubectl config use-context {kube_context}'
-                    .format(kube_context = config_dict['kube_context']),
-                    echo=True)
-        ctx.run('kubectl config set-context --current --namespace={namespace}'
-                    .format(namespace=config_dict['namespace']),
-                    echo=True)
-
-    # v2 (or v3 when kube_context is not specified)
-    elif version.parse(str(settings_dict['version'])) >= version.parse('2'):
-        if provider_data.get('name') == 'gcp':
-            if provider_data.get('zone') is not None:
-                get_zone = provider_data['zone']
-            elif provider_data.get('region') is not None:
-                get_zone = provider_data['region']
-
-            ctx.run('kubectl config use-context {name}_{project}_{cluster}_{zone}'
-                ' --namespace={namespace}'
-                .format(namespace=config_dict['namespace'],
-                        project=provider_data['project'],
-                        cluster=provider_data['kube_cluster'],
-                        name=provider_data['name'],
-                        zone=get_zone),
-                echo=True)
-            ctx.run('kubectl config set-context --current'
-                ' --namespace={namespace}'
-                .format(namespace=config_dict['namespace']),
-                echo=True)
-
-        elif provider_data.get('name') == 'azure':
-            ctx.run('kubectl config use-context {name}_{cluster}_{region}'
-                ' --namespace={namespace}'
-                .format(namespace=config_dict['namespace'],
-                        cluster=provider_data['kube_cluster'],
-                        name=provider_data['name'],
-                        region=provider_data['region']),
-                echo=True)
-            ctx.run('kubectl config set-context --current'
-                ' --namespace={namespace}'
-                .format(namespace=config_dict['namespace']),
-                echo=True)
-        else:
-            sys.exit(f"Invalid provider name in rdeploy file: {provider_data.get('name')}")
-
-    # Config file v1 or no version
-    # Backwards compatible with initial version of rdeploy where config file was not yet versioned.
-    else:
-        ctx.run('kubectl config use-context gcp_{cloud_project}_{cluster}_europe-west1-c'
-            ' --namespace={namespace}'
-            .format(namespace=config_dict['namespace'],
-                    cloud_project=config_dict['cloud_project'],
-                    cluster=config_dict['cluster']),
-            echo=True)
-        ctx.run('kubectl config set-context --current'
-            ' --namespace={namespace}'
-            .format(namespace=config_dict['namespace']),
-            echo=True)
+    get_deployer(ctx).config(config).set_context()
+
+
+# Preflight
+###########
+@task(help={'config': 'Only check the tools needed by this config'})
+def doctor(ctx, config=None):
+    """
+    Checks that the tools rdeploy runs are installed and reports their versions
+    """
+    results = get_deployer(ctx).doctor([config] if config else None)
+
+    row = '{:<10} {:<12} {}'
+    print(row.format('TOOL', 'VERSION', 'PATH'))
+    for result in results:
+        print(row.format(result['tool'], result['version'] or '-',
+                         result['path'] or result['binary']))
+
+    errors = ['{}: {}'.format(result['binary'], result['error'])
+              for result in results if result['error']]
+    if errors:
+        sys.exit('\n'.join(errors))
+
 
 # Versioning Helpers
 ####################
@@ -189,65 +77,19 @@ def next_version(ctx, bump):
     """
     Returns incremented version number by looking at git tags
     """
-    # Get latest git tag:
-    try:
-        latest_tag = latest_version(ctx)
-    except ReleaseError:
-        latest_tag = '0.0.0'
-
-    increment = {
-        'build': semver.bump_build,
-        'patch': semver.bump_patch,
-        'minor': semver.bump_minor,
-        'major': semver.bump_major
-    }
-
-    if bump in ['pre-patch','pre-minor','pre-major']:
-        incremented = increment[bump[4:]](latest_tag)
-        try:
-            #Check
-            incremented = semver.bump_prerelease(latest_prerelease(ctx, incremented)) # Try to increment the pre-release if there are existing pre-releases
-        except:
-            # No existing pre-release, so create one
-            incremented =  semver.bump_prerelease(incremented)
-        
-    else:
-        incremented = increment[bump](latest_tag)
-
-    return incremented
+    return get_deployer(ctx).next_version(bump)
 
 
 @task(aliases=['latest-version'])
 def latest_version(ctx):
     """Checks the git tags and returns the current latest version"""
-    ctx.run('git fetch --tags')
-    result = ctx.run('git tag --sort=-v:refname', hide='both')
-    tags = result.stdout.split('\n')
-
-    regex = re.compile(r'^v?(0|[1-9]\d*)\.(0|[1-9]\d*)\.(0|[1-9]\d*)$')
+    return get_deployer(ctx).latest_version()
 
-    version_tags = filter(regex.search, tags)
-    try:
-        latest_tag = next(version_tags)
-        return latest_tag[1:] if latest_tag.startswith('v') else latest_tag
-    except StopIteration:
-        raise ReleaseError('No valid semver tags found in repository')
 
 @task(aliases=['latest-prerelese'])
 def latest_prerelease(ctx, version):
     """Checks the git tags and returns the current latest version"""
-    ctx.run('git fetch --tags')
-    result = ctx.run('git tag --sort=-v:refname', hide='both')
-    tags = result.stdout.split('\n')
-
-    regex = re.compile(r'^v?{}(?:-((?:0|[1-9]\d*|\d*[a-zA-Z-][0-9a-zA-Z-]*)(?:\.(?:0|[1-9]\d*|\d*[a-zA-Z-][0-9a-zA-Z-]*))*))?(?:\+([0-9a-zA-Z-]+(?:\.[0-9a-zA-Z-]+)*))?$'.format(version))
-    version_tags = filter(regex.search, tags)
-    
-    try:
-        latest_tag = next(version_tags)
-        return latest_tag[1:] if latest_tag.startswith('v') else latest_tag
-    except StopIteration:
-        raise ReleaseError('No valid semver tags found in repository')
+    return get_deployer(ctx).latest_prerelease(version)
 
 
 # Kubernetes and GCloud Commands
@@ -257,13 +99,7 @@ def create_namespace(ctx, config):
     """
     Updates kubernetes deployment to use specified version
     """
-    settings_dict = get_settings()
-    config_dict = settings_dict['configs'][config]
-    set_context(ctx, config)
-
-    ctx.run('kubectl create namespace {namespace}'
-            .format(namespace=config_dict['namespace']),
-            echo=True)
+    get_deployer(ctx).config(config).create_namespace()
 
 
 @task(aliases=['upload-secrets'])
@@ -271,19 +107,7 @@ def upload_secrets(ctx, config, env_file):
     """
     Updates kubernetes deployment to use specified version
     """
-    settings_dict = get_settings()
-    config_dict = settings_dict['configs'][config]
-    set_context(ctx, config)
-
-    ctx.run('kubectl delete secret {project_name}'\
-            .format(project_name=config_dict['project_name'],
-                    namespace=config_dict['namespace']),
-            warn=True)
-
-    ctx.run('kubectl create secret generic {project_name}'
-            ' --from-env-file {env_file}'
-            .format(project_name=config_dict['project_name'],
-                    env_file=env_file))
+    get_deployer(ctx).config(config).upload_secrets(env_file)
 
 
 @task(aliases=['decode-secret'])
@@ -291,10 +115,7 @@ def decode_secret(ctx, config, secret):
     """
     Prints the decoded values of a kubernetes secret
     """
-    set_context(ctx, config)
-    o = io.StringIO()
-    ctx.run('kubectl get secret {secret} -o yaml'.format(secret=secret),out_stream=o)
-    print(yaml_decode_data_fields(o.getvalue()))
+    print(yaml.safe_dump(get_deployer(ctx).config(config).decode_secret(secret), indent=2))
 
 
 @task(aliases=['create-volume'])
@@ -310,33 +131,19 @@ def create_volume(ctx, name,
 @task(aliases=['upload-static'])
 def upload_static(ctx, config, bucket_name):
     """Upload static files to gcloud bucket"""
-    set_project(ctx, config)
-
-    ctx.run('echo "yes\n" | python src/manage.py collectstatic')
-    ctx.run('gsutil -m rsync -d -r var/www/static gs://{bucket_name}'
-            .format(bucket_name=bucket_name), echo=False)
+    get_deployer(ctx).config(config).upload_static(bucket_name)
 
 
 @task(aliases=['create-bucket'])
 def create_bucket(ctx, config, bucket_name):
     """Creates gcloud bucket for static files"""
-    set_project(ctx, config)
-
-    ctx.run('gsutil mb gs://{bucket_name}'
-            .format(bucket_name=bucket_name), echo=False)
-    ctx.run('gsutil defacl set private gs://{bucket_name}'
-            .format(bucket_name=bucket_name), echo=False)
-
+    get_deployer(ctx).config(config).create_bucket(bucket_name)
 
 
 @task(aliases=['create-public-bucket'])
 def create_public_bucket(ctx, config, bucket_name):
     """Creates gcloud bucket for static files"""
-    set_project(ctx, config)
-
-    ctx.run('gsutil mb -b on gs://{bucket_name}'.format(bucket_name=bucket_name))
-    ctx.run('gsutil iam ch allUsers:objectViewer gs://{bucket_name}'
-            .format(bucket_name=bucket_name))
+    get_deployer(ctx).config(config).create_public_bucket(bucket_name)
 
 
 @task
@@ -344,164 +151,131 @@ def install(ctx, config):
     """
     Installs kubernetes deployment
     """
-    settings_dict = get_settings()
-    config_dict = settings_dict['configs'][config]
-    set_context(ctx, config)
-
-    helm_bin = get_helm_bin(config_dict)
-
-    install_flag = ''
-
-    if config_dict.get('helm_version') and version.parse(str(config_dict['helm_version'])) <= version.parse('3'):
-        install_flag = " --name"
-        
-    provider_data = config_dict.get('cloud_provider')
-    helm_registry = provider_data.get('helm_registry')
-    if provider_data.get('name') == 'gcp' and helm_registry:
-        # Authenticate with the GCP Artifact Registry
-        ctx.run('gcloud auth print-access-token | {helm_bin} registry login -u oauth2accesstoken --password-stdin https://{helm_registry}'.format(helm_registry=helm_registry, helm_bin=helm_bin), echo=True)
-        helm_chart = 'oci://{helm_registry}/{gcp_project}/{helm_chart}'.format(helm_registry=helm_registry, gcp_project=provider_data['project'], helm_chart=config_dict['helm_chart'])
-    else:
-        # Add the Rehive Helm Repo
-        ctx.run('{helm_bin} repo add rehive https://rehive.github.io/charts'.format(helm_bin=helm_bin), echo=True)
-        helm_chart = config_dict['helm_chart']
-    
-    ctx.run('{helm_bin} install{helm_install_flag} {project_name} '
-            '--values {helm_values_path} '
-            '--version {helm_chart_version} {helm_chart}'
-            .format(helm_bin=helm_bin,
-                    project_name=config_dict['project_name'],
-                    helm_install_flag=install_flag,
-                    helm_values_path=config_dict['helm_values_path'],
-                    helm_chart=helm_chart,
-                    helm_chart_version=config_dict['helm_chart_version']),
-            echo=True)
+    get_deployer(ctx).config(config).install()
 
 
-@task
-def upgrade(ctx, config, version):
+@task(help={'waves': 'Treat CONFIG as a rollout in rdeploy.yaml and upgrade its configs in waves',
+            'prepull': 'Pull the new image onto the deployment\'s nodes before upgrading',
+            'skip_unchanged': 'Skip configs whose tag, chart and values are unchanged since '
+                              'their last upgrade from this machine'})
+def upgrade(ctx, config, version, waves=False, prepull=False, skip_unchanged=False):
     """
     Upgrades kubernetes deployment
     """
+    deployer = get_deployer(ctx)
+    if not waves:
+        deployer.config(config).upgrade(version, prepull=prepull, skip_unchanged=skip_unchanged)
+        return
 
-    settings_dict = get_settings()
-    config_dict = settings_dict['configs'][config]
-    set_context(ctx, config)
-
-    helm_bin = get_helm_bin(config_dict)
-    
-    provider_data = config_dict.get('cloud_provider')
-    helm_registry = provider_data.get('helm_registry')
-    if provider_data.get('name') == 'gcp' and helm_registry:
-        # Authenticate with the GCP Artifact Registry
-        ctx.run('gcloud auth print-access-token | {helm_bin} registry login -u oauth2accesstoken --password-stdin https://{helm_registry}'.format(helm_registry=helm_registry, helm_bin=helm_bin), echo=True)
-        helm_chart = 'oci://{helm_registry}/{gcp_project}/{helm_chart}'.format(helm_registry=helm_registry, gcp_project=provider_data['project'], helm_chart=config_dict['helm_chart'])
-    else:
-        helm_chart = config_dict['helm_chart']
+    plan = deployer.rollout_waves(config)
+    for wave_name, configs in plan:
+        print('{}: {}'.format(wave_name, ', '.join(configs)))
+
+    def on_wave(wave_name, errors):
+        print('\nWave {}:'.format(wave_name))
+        for name, error in errors.items():
+            print('  {:<20} {}'.format(name, error or 'ready'))
 
-    ctx.run('{helm_bin} upgrade {project_name} '
-            '--values {helm_values_path} '
-            '--set image.tag={version} '
-            '--version {helm_chart_version} {helm_chart}'
-            .format(helm_bin=helm_bin,
-                    project_name=config_dict['project_name'],
-                    helm_chart=helm_chart,
-                    helm_values_path=config_dict['helm_values_path'],
-                    version=version,
-                    helm_chart_version=config_dict['helm_chart_version']),
-            echo=True)
+    result = deployer.rollout(config, version, on_wave=on_wave, prepull=prepull,
+                              skip_unchanged=skip_unchanged)
+    if not result['succeeded']:
+        if result['rolled_back']:
+            print('\nRolled back: {}'.format(', '.join(result['rolled_back'])))
+        sys.exit('Rollout {} failed'.format(config))
+
+
+@task(help={'env_file': 'Env file for the project secret, defaults to bootstrap.env_file in rdeploy.yaml'})
+def bootstrap(ctx, config, env_file=None):
+    """
+    Creates the namespace, secrets and pull secrets and installs the release
+    """
+    get_deployer(ctx).config(config).bootstrap(env_file)
 
 
 @task
 def helm(ctx, config, command):
-    settings_dict = get_settings()
-    config_dict = settings_dict['configs'][config]
-    set_context(ctx, config)
+    get_deployer(ctx).config(config).helm(command)
+
 
-    helm_bin = get_helm_bin(config_dict)
+@task(help={'kind': 'Only list resources of this kind, e.g. Deployment'})
+def manifest(ctx, config, kind=None):
+    """Lists the resources in the deployed helm release"""
+    def on_document(document):
+        if not kind or document.get('kind') == kind:
+            print('{}/{}'.format(document.get('kind'), document['metadata']['name']))
 
-    ctx.run('{helm_bin} {command}'.format(helm_bin=helm_bin,
-                                          command=command),
-            echo=True)
+    get_deployer(ctx).config(config).manifest(on_document)
 
 
 @task(aliases=['helm-setup'])
 def helm_setup(ctx, config):
-    settings_dict = get_settings()
-    config_dict = settings_dict['configs'][config]
-
-    helm_version = config_dict.get('helm_version')
-    if not helm_version:
-        print('Please add the helm_version config to rdeploy.yaml.')
-        return
-
-    if config_dict.get('use_system_helm', True):
-        print('Please add the following config to rdeploy.yaml:\n'
-              'use_system_helm: false')
+    try:
+        install_path = get_deployer(ctx).config(config).helm_setup()
+    except ExecuteError as e:
+        print(e)
         return
 
-    if sys.platform == 'linux' or sys.platform == 'linux2':
-        os_string = 'linux-amd64'
-        archive_tool = tarfile
-    elif sys.platform == 'darwin':
-        os_string = 'darwin-amd64'
-        archive_tool = tarfile
-    elif sys.platform == 'win32':
-        os_string = 'windows-amd64'
-        archive_tool = zipfile
-
-    url = 'https://get.helm.sh/helm-v{version}-{os_string}.tar.gz'.format(version=helm_version,
-                                                                          os_string=os_string)
-    file_tmp = urllib.request.urlretrieve(url, filename=None)[0]
-    tar = archive_tool.open(file_tmp)
-    tar.extractall('./opt/helm-v{version}'.format(version=helm_version))
-
-    helm_bin = get_helm_bin(config_dict)
-    
-    provider = config_dict.get('cloud_provider')
-    helm_registry = provider.get('helm_registry')
-    if not (provider.get('name') == 'gcp' and helm_registry):
-        ctx.run('{helm_bin} repo add stable https://charts.helm.sh/stable'.format(helm_bin=helm_bin), echo=True)
-        ctx.run('{helm_bin} repo add rehive https://rehive.github.io/charts'.format(helm_bin=helm_bin), echo=True)
-
-    print('Successfully installed helm to opt/helm-v{version}/{os_string}/ \n'
-          'Please make sure this directory has been added to .gitignore.'. format(version=helm_version,
-                                                                                  os_string=os_string))
+    print('Successfully installed helm to {} \n'
+          'Please make sure this directory has been added to .gitignore.'.format(install_path))
 
 
 @task(aliases=['live-image'])
 def live_image(ctx, config):
     """Displays the current docker image and version deployed"""
-    settings_dict = get_settings()
-    config_dict = settings_dict['configs'][config]
-    set_context(ctx, config)
-
-    result = ctx.run('kubectl get deployment {project_name} --output=json'
-                     .format(project_name=config_dict['project_name']),
-                     echo=True, hide='stdout')
-    server_config = json.loads(result.stdout)
-    image = server_config['spec']['template']['spec']['containers'][0]['image']
-    print(image)
+    print(get_deployer(ctx).config(config).live_image())
+
+
+@task(help={'config': 'Config to report on, omit with --all',
+            'all': 'Report on every config in rdeploy.yaml',
+            'ttl': 'Seconds to reuse cached results for, 0 to always query (default 10)'})
+def status(ctx, config=None, all=False, ttl=10):
+    """Displays the deployed image, chart version and replicas of configs"""
+    deployer = get_deployer(ctx)
+    if all:
+        configs = list(deployer.settings['configs'])
+    elif config:
+        configs = [config]
+    else:
+        sys.exit('Please specify a config or --all')
+
+    results = deployer.status(configs, ttl=int(ttl))
+
+    row = '{:<20} {:<40} {:<16} {:<10} {:<8} {}'
+    print(row.format('CONFIG', 'IMAGE', 'TAG', 'CHART', 'READY', 'AGE'))
+    for config in configs:
+        result = results[config]
+        if 'error' in result:
+            print('{:<20} {}'.format(config, result['error']))
+            continue
+        print(row.format(config, result['image'], result['tag'], result['chart_version'],
+                         '{}/{}'.format(result['ready_replicas'], result['desired_replicas']),
+                         format_age(result['rollout_age'])))
+
+
+@task(help={'since': 'Only show logs newer than a duration, e.g. 30s, 10m, 2h',
+            'grep': 'Only show lines matching this regular expression',
+            'follow': 'Keep streaming, including pods started during a rollout'})
+def logs(ctx, config, since=None, grep=None, follow=False):
+    """Streams the logs of all pods of a deployment"""
+    try:
+        get_deployer(ctx).config(config).logs(
+            since_seconds=parse_duration(since) if since else None,
+            pattern=re.compile(grep) if grep else None,
+            follow=follow)
+    except KeyboardInterrupt:
+        pass
 
 
 @task(aliases=['bash'])
 def shell(ctx, config, tag=None):
     """Exec into the management container"""
-    set_context(ctx, config)
-    settings_dict = get_settings()
-    config_dict = settings_dict['configs'][config]
-    management_cmd = build_management_cmd(config_dict, "/bin/bash", tag)
-    ctx.run(management_cmd, pty=True, warn=False, echo=True)
+    get_deployer(ctx).config(config).shell(tag)
 
 
 @task
 def manage(ctx, config, cmd, tag=None):
     """Exec into the management container"""
-    set_context(ctx, config)
-    settings_dict = get_settings()
-    config_dict = settings_dict['configs'][config]
-    management_cmd = build_management_cmd(config_dict, f'python manage.py {cmd}', tag)
-    ctx.run(management_cmd, pty=True, warn=False, echo=True)
+    get_deployer(ctx).config(config).manage(cmd, tag)
 
 
 @task
@@ -527,7 +301,7 @@ def git_release(ctx, version_bump, force=False):
         sys.exit("Please specify pre-patch, pre-minor or pre-major for prereleases.")
 
 
-    bumped_version = next_version(ctx, bump=version_bump)
+    bumped_version = get_deployer(ctx).next_version(version_bump)
     tag = 'v' + bumped_version
     comment = 'Version ' + bumped_version
 
@@ -542,15 +316,7 @@ def build(ctx, config, tag):
     """
     Build project's docker image and pushes to remote repo
     """
-    settings_dict = get_settings()
-    config_dict = settings_dict['configs'][config]
-    set_project(ctx, config)
-    image_name = config_dict['docker_image'].split(':')[0]
-    image = '{}:{}'.format(image_name, tag)
-    ctx.run('docker build -t %s -f etc/docker/Dockerfile .' % image, echo=True)
-    ctx.run('gcloud auth configure-docker', echo=True)
-    ctx.run('docker push %s' % image, echo=True)
-    return image
+    return get_deployer(ctx).config(config).build(tag)
 
 
 @task
@@ -558,61 +324,21 @@ def cloudbuild(ctx, config, tag):
     """
     Build project's docker image using google cloud builder and pushes to remote repo
     """
-    settings_dict = get_settings()
-    config_dict = settings_dict['configs'][config]
-    image_name = config_dict['docker_image'].split(':')[0]
-
-    if config_dict.get('container_registry_provider') == 'google':
-        project = config_dict['docker_image'].split('/')[1]
-        ctx.run('gcloud config set project {project}'
-            .format(project=project), echo=True)
-    else:
-        set_project(ctx, config)
-
-
-    if settings_dict.get('version') and version.parse(str(settings_dict['version'])) > version.parse('1'):
-        provider_data = config_dict.get('cloud_provider')
-
-        def azure_image_build(container_registry, image_name, tag):
-            ctx.run('az acr run'
-                ' -r {container_registry}'
-                ' -f ./etc/docker/acr.yaml'
-                ' --set IMAGE={image_name}'
-                ' --set TAG_NAME={tag_name}'
-                ' .'
-                .format(container_registry=container_registry,
-                        image_name=image_name,
-                        tag_name=tag), echo=True)
-
-        def google_image_build(project, image_name, tag):
-            log_dir = "gs://{project}-cloudbuild-logs/{image}/{tag_name}/".format(
-            project=project, image=image_name, tag_name=tag)
-            ctx.run('gcloud builds submit .'
-                ' --config etc/docker/cloudbuild.yaml'
-                ' --substitutions _IMAGE={image_name},TAG_NAME={tag_name}'
-                ' --gcs-log-dir {log_dir}'
-                .format(image_name=image_name, tag_name=tag, log_dir=log_dir),
-                echo=True)
-
-        if config_dict.get('container_registry_provider') == 'azure':
-            azure_image_build(provider_data['container_registry'], image_name, tag)
-
-        elif config_dict.get('container_registry_provider') == 'google':
-            project = config_dict['docker_image'].split('/')[1]
-            google_image_build(project, image_name, tag)
-
-        else:
-            if provider_data and provider_data['name'] == 'azure':
-                azure_image_build(provider_data['container_registry'], image_name, tag)
-            else:
-                google_image_build(provider_data['project'], image_name, tag)
+    get_deployer(ctx).config(config).cloudbuild(tag)
 
-    else:
-        log_dir = "gs://{project}-cloudbuild-logs/{image}/{tag_name}/".format(
-        project=config_dict['cloud_project'], image=image_name, tag_name=tag)
-        ctx.run('gcloud builds submit .'
-                ' --config etc/docker/cloudbuild-no-cache.yaml'
-                ' --substitutions _IMAGE={image_name},TAG_NAME={tag_name}'
-                ' --gcs-log-dir {log_dir}'
-                .format(image_name=image_name, tag_name=tag, log_dir=log_dir),
-                echo=True)
+
+# Daemon
+########
+@task(help={'socket': 'Unix socket path, defaults to $RDEPLOY_SOCKET or ~/.cache/rdeploy/rdeploy.sock',
+            'stop': 'Stop the running daemon'})
+def serve(ctx, socket=None, stop=False):
+    """
+    Runs a background daemon that keeps settings and clients warm.
+    While it is running, `rdeploy` forwards commands to it.
+    """
+    if stop:
+        if not daemon.stop(socket):
+            print('rdeploy daemon is not running')
+        return
+
+    daemon.serve(socket)
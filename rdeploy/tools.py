@@ -0,0 +1,93 @@
+"""
+Versions of the external tools rdeploy drives.
+
+Each binary is probed by running its version command. Results are cached in
+tools.json keyed by the binary's resolved path and mtime, so a version is
+only probed again after the binary is replaced (e.g. upgraded or installed
+with `helm-setup`).
+"""
+import os
+import re
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from rdeploy import cache
+
+
+CACHE_FILE = 'tools.json'
+PROBE_TIMEOUT = 15
+
+# Arguments printing each tool's client version without contacting a server
+VERSION_ARGS = {
+    'helm': ['version', '--client', '--short'],
+    'kubectl': ['version', '--client'],
+    'gcloud': ['version'],
+    'az': ['version'],
+    'docker': ['--version'],
+    'git': ['--version'],
+}
+
+VERSION_PATTERN = re.compile(r'(\d+\.\d+(?:\.\d+)?)')
+
+
+def _resolve(binary):
+    """Returns the absolute path of a binary, looking it up on $PATH unless it is a path"""
+    if os.sep in binary:
+        return os.path.abspath(binary) if os.path.isfile(binary) else None
+    return shutil.which(binary)
+
+
+def _run_probe(tool, path):
+    try:
+        result = subprocess.run([path] + VERSION_ARGS[tool], stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+                                timeout=PROBE_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        return {'version': None, 'error': str(e)}
+    output = result.stdout.decode('utf-8', errors='replace')
+    match = VERSION_PATTERN.search(output)
+    if not match:
+        first_line = output.strip().split('\n')[0]
+        return {'version': None, 'error': first_line or f'exited with {result.returncode}'}
+    return {'version': match.group(1), 'error': None}
+
+
+def probe(tools):
+    """
+    Returns the versions of `tools`, a list of (tool, binary) pairs such as
+    ('helm', 'opt/helm-v3.0.3/linux-amd64/helm'). Uncached binaries are
+    probed concurrently. Each result is a dict with the `tool`, `binary`,
+    resolved `path`, `version` and an `error` when it could not be found
+    or probed.
+    """
+    cached = cache.load(CACHE_FILE)
+    results = []
+    pending = []
+    for tool, binary in tools:
+        result = {'tool': tool, 'binary': binary, 'path': _resolve(binary),
+                  'version': None, 'error': None}
+        results.append(result)
+        if result['path'] is None:
+            result['error'] = 'not found'
+            continue
+        mtime = os.stat(result['path']).st_mtime_ns
+        entry = cached.get(result['path'])
+        if entry and entry['mtime'] == mtime:
+            result.update(version=entry['version'], error=entry['error'])
+        else:
+            pending.append((result, mtime))
+
+    if pending:
+        with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+            probes = executor.map(lambda item: _run_probe(item[0]['tool'], item[0]['path']), pending)
+            for (result, mtime), outcome in zip(pending, probes):
+                result.update(outcome)
+                cached[result['path']] = dict(outcome, mtime=mtime)
+        cache.save(CACHE_FILE, cached)
+    return results
+
+
+def tool_version(tool, binary=None):
+    """Returns the cached, or freshly probed, version of a tool, None if unavailable"""
+    return probe([(tool, binary or tool)])[0]['version']
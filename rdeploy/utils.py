@@ -2,18 +2,23 @@ import os
 import yaml
 import json
 import base64
+import re
 
 
 try:
     from yaml import CLoader as Loader
 except ImportError:
     from yaml import Loader
+import sys
 from sys import platform
 
 
 from distutils.util import strtobool
 from invoke.exceptions import ParseError
 from json import dumps
+from packaging import version
+from concurrent.futures import ThreadPoolExecutor
+from . import cache, kube
 from .exceptions import ExecuteError
 
 
@@ -31,13 +36,142 @@ def format_yaml(template, config):
     return formatted
 
 
+_settings_cache = {}
+
+
 def get_settings(path="rdeploy.yaml"):
-    """Import project settings"""
-    with open(path, 'r') as stream:
+    """
+    Import project settings
+
+    Parsed settings are cached per file and reused until the file's mtime
+    changes, so long-lived processes (e.g. `rdeploy serve`) only parse the
+    YAML once.
+    """
+    real_path = os.path.realpath(path)
+    mtime = os.stat(real_path).st_mtime_ns
+    cached = _settings_cache.get(real_path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(real_path, 'r') as stream:
         settings_dict = yaml.load(stream, Loader=Loader)
+    _settings_cache[real_path] = (mtime, settings_dict)
     return settings_dict
 
 
+def get_kube_context(settings_dict: dict, config_dict: dict) -> str:
+    """
+    Returns the kube context name of a config, following the naming
+    convention of the rdeploy.yaml version in use.
+    """
+    settings_version = settings_dict.get('version')
+    provider_data = config_dict.get('cloud_provider')
+
+    # Check for future versions
+    if settings_version and version.parse(str(settings_version)) > version.parse('3'):
+        sys.exit(f"Unsupported rdeploy.yaml version, please upgrade rdeploy or double check the version number.")
+
+    # v3 of the config file uses the kube_context value to set the kubernetes cluster context
+    # whereas previous versions used the GCP/AZ tools to set it and a naming convention
+    elif str(settings_version) == '3' and config_dict.get('kube_context'):
+        return config_dict['kube_context']
+
+    # v2 (or v3 when kube_context is not specified)
+    elif settings_version and version.parse(str(settings_version)) >= version.parse('2'):
+        if provider_data.get('name') == 'gcp':
+            if provider_data.get('zone') is not None:
+                zone = provider_data['zone']
+            elif provider_data.get('region') is not None:
+                zone = provider_data['region']
+
+            return '{name}_{project}_{cluster}_{zone}'.format(
+                project=provider_data['project'],
+                cluster=provider_data['kube_cluster'],
+                name=provider_data['name'],
+                zone=zone)
+
+        elif provider_data.get('name') == 'azure':
+            return '{name}_{cluster}_{region}'.format(
+                cluster=provider_data['kube_cluster'],
+                name=provider_data['name'],
+                region=provider_data['region'])
+        else:
+            sys.exit(f"Invalid provider name in rdeploy file: {provider_data.get('name')}")
+
+    # Config file v1 or no version
+    # Backwards compatible with initial version of rdeploy where config file was not yet versioned.
+    else:
+        return 'gcp_{cloud_project}_{cluster}_europe-west1-c'.format(
+            cloud_project=config_dict['cloud_project'],
+            cluster=config_dict['cluster'])
+
+
+def format_age(seconds: int) -> str:
+    """Formats a duration the way kubectl does, e.g. 45s, 12m, 3h, 5d"""
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds >= size:
+            return f'{seconds // size}{unit}'
+    return f'{seconds}s'
+
+
+def parse_duration(duration: str) -> int:
+    """Parses a duration such as 30s, 10m, 2h or 1d into seconds"""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    match = re.fullmatch(r'(\d+)([smhd]?)', duration.strip())
+    if not match:
+        raise ParseError(f'Invalid duration: {duration}')
+    return int(match.group(1)) * units[match.group(2) or 's']
+
+
+def get_fleet_status(settings_dict: dict, configs: list, ttl: int = 10) -> dict:
+    """
+    Returns the deployment status of each config, keyed by config name.
+
+    Configs are grouped by kube context so each cluster is queried through a
+    single shared client, and all deployments are read concurrently. Results
+    younger than `ttl` seconds are served from the on-disk cache. Failures
+    are reported as a status with an `error` entry.
+    """
+    status_cache = cache.load('status.json')
+    results = {}
+    clusters = {}
+    for config in configs:
+        config_dict = settings_dict['configs'][config]
+        kube_context = get_kube_context(settings_dict, config_dict)
+        key = '{}/{}/{}'.format(kube_context, config_dict['namespace'], config_dict['project_name'])
+        cached = cache.get_fresh(status_cache, key, ttl) if ttl else None
+        if cached is not None:
+            results[config] = cached
+        else:
+            clusters.setdefault(kube_context, []).append((config, key))
+
+    if not clusters:
+        return results
+
+    def fetch(kube_context, config):
+        config_dict = settings_dict['configs'][config]
+        deployment = kube.read_deployment(config_dict['project_name'],
+                                          config_dict['namespace'],
+                                          kube_context)
+        return kube.deployment_status(deployment, config_dict.get('helm_chart'))
+
+    with ThreadPoolExecutor(max_workers=min(32, sum(len(c) for c in clusters.values()))) as executor:
+        futures = {}
+        for kube_context, cluster_configs in clusters.items():
+            for config, key in cluster_configs:
+                futures[executor.submit(fetch, kube_context, config)] = (config, key)
+
+        for future, (config, key) in futures.items():
+            try:
+                results[config] = future.result()
+                cache.set_fresh(status_cache, key, results[config])
+            except (Exception, ExecuteError) as e:
+                results[config] = {'error': str(e)}
+
+    cache.save('status.json', status_cache)
+    return results
+
+
 def confirm(prompt='Continue?\n', failure_prompt='User cancelled task'):
     """
     Prompt the user to continue. Repeat on unknown response. Raise
@@ -98,31 +232,75 @@ def decode_data_value(encoded_value):
         return decoded_value
 
 
+def encode_data_value(value) -> str:
+    if isinstance(value, str):
+        value = value.encode()
+    return base64.b64encode(value).decode()
+
+
+def parse_env_file(path: str) -> dict:
+    """
+    Reads KEY=VALUE lines the way `kubectl create secret --from-env-file`
+    does. Blank lines and comments are skipped and values are not unquoted.
+    """
+    data = {}
+    with open(path, 'r') as stream:
+        for number, line in enumerate(stream, 1):
+            line = line.lstrip().rstrip('\r\n')
+            if not line or line.startswith('#'):
+                continue
+            key, sep, value = line.partition('=')
+            if not sep or not key.strip():
+                raise ExecuteError(f'{path}:{number}: expected KEY=VALUE')
+            data[key.strip()] = value
+    return data
+
+
+def build_bootstrap_manifest(config_dict: dict, env_file: str = None) -> str:
+    """
+    Returns a multi-document manifest with a config's namespace, its
+    project secret read from `env_file` and the image pull secrets listed
+    under `bootstrap.image_pull_secrets`.
+    """
+    namespace = config_dict['namespace']
+    bootstrap = config_dict.get('bootstrap') or {}
+    env_file = env_file or bootstrap.get('env_file')
+
+    documents = [{
+        'apiVersion': 'v1',
+        'kind': 'Namespace',
+        'metadata': {'name': namespace},
+    }]
+    if env_file:
+        documents.append({
+            'apiVersion': 'v1',
+            'kind': 'Secret',
+            'metadata': {'name': config_dict['project_name'], 'namespace': namespace},
+            'type': 'Opaque',
+            'data': {key: encode_data_value(value)
+                     for key, value in parse_env_file(env_file).items()},
+        })
+    for pull_secret in bootstrap.get('image_pull_secrets') or []:
+        with open(os.path.expanduser(pull_secret['docker_config']), 'rb') as stream:
+            docker_config = stream.read()
+        documents.append({
+            'apiVersion': 'v1',
+            'kind': 'Secret',
+            'metadata': {'name': pull_secret['name'], 'namespace': namespace},
+            'type': 'kubernetes.io/dockerconfigjson',
+            'data': {'.dockerconfigjson': encode_data_value(docker_config)},
+        })
+    return yaml.safe_dump_all(documents, default_flow_style=False)
+
+
 def build_management_cmd(config_dict: dict, cmd: str = "", tag: str = "") -> str:
-    from kubernetes import client, config
     from kubernetes.client.models import V1Container
     from kubernetes.client.rest import ApiException
-    from kubernetes.config.kube_config import KubeConfigMerger, KubeConfigLoader, KUBE_CONFIG_DEFAULT_LOCATION
-    from kubernetes.config.config_exception import ConfigException
-
-    config.load_kube_config()
-
-    # Workaround to read the proxy-url as it is not currently read by load_kube_config()
-    # TODO: submit as pull request to kubernetes python
-    try:
-        kcfg = KubeConfigMerger(KUBE_CONFIG_DEFAULT_LOCATION)
-        k = KubeConfigLoader(config_dict=kcfg.config)
-        proxy_url = k._cluster['proxy-url']
-    except ConfigException:
-        proxy_url = None
 
     if tag is not None:
         print(tag)
 
-    if proxy_url is not None:
-        client.Configuration._default.proxy = proxy_url
-
-    app_v1_api = client.AppsV1Api()
+    app_v1_api = kube.apps_v1_api()
 
     try:
         deployment = app_v1_api.read_namespaced_deployment(
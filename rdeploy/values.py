@@ -0,0 +1,88 @@
+"""
+Layered helm values.
+
+`helm_values_path` may list several files, a shared base first and
+per-config overlays after it. They are merged the way helm merges several
+--values files and the result is cached under the rdeploy cache directory,
+keyed by the content hashes of the inputs. Helm then reads one pre-merged
+file, and whether a config's values changed is a hash comparison.
+"""
+import hashlib
+import os
+import tempfile
+
+from rdeploy import cache
+from rdeploy.exceptions import ExecuteError
+
+
+VALUES_DIR = 'values'
+
+
+def values_paths(config_dict):
+    """Returns the values files of a config, base first"""
+    paths = config_dict['helm_values_path']
+    return [paths] if isinstance(paths, str) else list(paths)
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as stream:
+            for chunk in iter(lambda: stream.read(65536), b''):
+                digest.update(chunk)
+    except OSError as e:
+        raise ExecuteError(f'Failed to read helm values {path}: {e.strerror}')
+    return digest.hexdigest()
+
+
+def merge(base, overlay):
+    """
+    Merges overlay values into base values: maps are merged recursively,
+    anything else, including lists, is replaced. Nulls are kept so that
+    helm can still use them to remove chart defaults.
+    """
+    merged = dict(base)
+    for key, value in overlay.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def merged_values(config_dict):
+    """
+    Returns the path of a single values file for a config and the hash of
+    its inputs. A single input is used as is, several are merged into a
+    cached file that is only rebuilt when an input's content changes.
+    """
+    paths = values_paths(config_dict)
+    hashes = [_file_hash(path) for path in paths]
+    if len(paths) == 1:
+        return paths[0], hashes[0]
+
+    key = hashlib.sha256('\n'.join(hashes).encode()).hexdigest()
+    values_dir = os.path.join(cache.get_cache_dir(), VALUES_DIR)
+    merged_path = os.path.join(values_dir, f'{key}.yaml')
+    if os.path.exists(merged_path):
+        return merged_path, key
+
+    import yaml
+
+    merged = {}
+    for path in paths:
+        with open(path, 'r') as stream:
+            merged = merge(merged, yaml.safe_load(stream) or {})
+
+    os.makedirs(values_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=values_dir, prefix=f'.{key}.')
+    with os.fdopen(fd, 'w') as stream:
+        yaml.safe_dump(merged, stream, default_flow_style=False, sort_keys=False)
+    os.replace(tmp_path, merged_path)
+    return merged_path, key
+
+
+def deploy_fingerprint(values_hash, image_tag, helm_chart, helm_chart_version):
+    """Returns a hash of everything an upgrade sends to helm"""
+    return hashlib.sha256('\n'.join([values_hash, str(image_tag), helm_chart,
+                                     str(helm_chart_version)]).encode()).hexdigest()
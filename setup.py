@@ -77,9 +77,12 @@ setup(
         # that you indicate whether you support Python 2, Python 3 or both.
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
     ],
 
+    # Module-level __getattr__ (PEP 562) in rdeploy/__init__.py needs 3.7
+    python_requires='>=3.7',
+
     # What does your project relate to?
     keywords='docker python helm kubernetes build automation deploy',
 
@@ -113,7 +116,7 @@ setup(
     # $ pip install -e .[dev,test]
     extras_require={
         'dev': parse_requirements(path.join(here, 'requirements.txt')),
-        'test': ['coverage'],
+        'test': ['coverage', 'pytest'],
     },
 
     # test_suite='nose.collector',
@@ -137,7 +140,7 @@ setup(
     # pip to create the appropriate form of executable for the target platform.
     entry_points={
         'console_scripts': [
-            'rdeploy = rdeploy.main:program.run'
+            'rdeploy = rdeploy.daemon:main'
         ],
     },
 )
@@ -0,0 +1,253 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from rdeploy import kube
+from rdeploy.exceptions import ExecuteError
+
+
+IMAGE = 'registry.example.com/example:1.2.4'
+OLD_IMAGE = 'registry.example.com/example:1.2.3'
+UID = 'daemon-set-uid'
+
+
+def make_deployment(**pod_spec):
+    spec = {'containers': [{'name': 'app', 'image': 'registry.example.com/example:1.2.3'}]}
+    spec.update(pod_spec)
+    return {
+        'metadata': {'name': 'example', 'namespace': 'example'},
+        'spec': {'template': {'spec': spec}},
+    }
+
+
+def make_pod(name, image_id='', waiting_reason='PodInitializing', message=None,
+             image=IMAGE, owner_uid=UID, deleting=False):
+    waiting = {'reason': waiting_reason}
+    if message:
+        waiting['message'] = message
+    metadata = {'name': name, 'ownerReferences': [
+        {'apiVersion': 'apps/v1', 'kind': 'DaemonSet', 'name': 'example-prepull', 'uid': owner_uid}]}
+    if deleting:
+        metadata['deletionTimestamp'] = '2026-10-19T12:00:00Z'
+    return {
+        'metadata': metadata,
+        'spec': {'initContainers': [{'name': 'prepull', 'image': image}],
+                 'containers': [{'name': 'pause', 'image': kube.PAUSE_IMAGE}]},
+        'status': {'initContainerStatuses': [{
+            'name': 'prepull', 'image': image, 'imageID': image_id,
+            'ready': False, 'restartCount': 0, 'state': {'waiting': waiting},
+        }]},
+    }
+
+
+# DaemonSet
+###########
+def test_daemon_set_copies_pull_secrets_and_scheduling():
+    deployment = make_deployment(
+        imagePullSecrets=[{'name': 'regcred'}],
+        serviceAccountName='example',
+        nodeSelector={'pool': 'apps'},
+        tolerations=[{'key': 'dedicated', 'operator': 'Exists'}],
+    )
+    daemon_set = kube.prepull_daemon_set(deployment, IMAGE)
+    spec = daemon_set['spec']['template']['spec']
+
+    assert daemon_set['metadata']['name'] == 'example-prepull'
+    assert spec['initContainers'][0]['image'] == IMAGE
+    assert spec['imagePullSecrets'] == [{'name': 'regcred'}]
+    assert spec['serviceAccountName'] == 'example'
+    assert spec['nodeSelector'] == {'pool': 'apps'}
+    assert spec['tolerations'] == [{'key': 'dedicated', 'operator': 'Exists'}]
+    assert daemon_set['spec']['selector']['matchLabels'] == \
+        daemon_set['spec']['template']['metadata']['labels']
+
+
+def test_daemon_set_only_copies_node_affinity():
+    node_affinity = {'requiredDuringSchedulingIgnoredDuringExecution': {'nodeSelectorTerms': [
+        {'matchExpressions': [{'key': 'pool', 'operator': 'In', 'values': ['apps']}]}]}}
+    pod_anti_affinity = {'requiredDuringSchedulingIgnoredDuringExecution': [
+        {'labelSelector': {'matchLabels': {'app': 'example'}},
+         'topologyKey': 'kubernetes.io/hostname'}]}
+    deployment = make_deployment(affinity={'nodeAffinity': node_affinity,
+                                           'podAntiAffinity': pod_anti_affinity})
+
+    spec = kube.prepull_daemon_set(deployment, IMAGE)['spec']['template']['spec']
+    assert spec['affinity'] == {'nodeAffinity': node_affinity}
+
+
+def test_daemon_set_without_affinity():
+    deployment = make_deployment(affinity={'podAntiAffinity': {}})
+    spec = kube.prepull_daemon_set(deployment, IMAGE)['spec']['template']['spec']
+    assert 'affinity' not in spec
+    assert 'imagePullSecrets' not in spec
+
+
+# Pulled pods
+#############
+def test_pulled_pods_counts_pods_with_image():
+    pods = [make_pod('a', image_id='sha256:1'), make_pod('b'), make_pod('c', image_id='sha256:1')]
+    assert kube._pulled_pods(pods, IMAGE, UID) == 2
+
+
+def test_pulled_pods_ignores_pods_without_status():
+    assert kube._pulled_pods([{'metadata': {'name': 'a'}}], IMAGE, UID) == 0
+
+
+def test_pulled_pods_ignores_stale_pods():
+    pods = [
+        make_pod('deleting', image_id='sha256:1', deleting=True),
+        make_pod('old-image', image_id='sha256:0', image=OLD_IMAGE),
+        make_pod('old-daemon-set', image_id='sha256:1', owner_uid='old-uid'),
+        make_pod('old-error', waiting_reason='ErrImagePull', image=OLD_IMAGE),
+    ]
+    assert kube._pulled_pods(pods, IMAGE, UID) == 0
+
+
+@pytest.mark.parametrize('reason', ['ErrImagePull', 'ImagePullBackOff', 'InvalidImageName'])
+def test_pulled_pods_raises_on_pull_errors(reason):
+    with pytest.raises(ExecuteError, match='not found'):
+        kube._pulled_pods([make_pod('a', waiting_reason=reason, message='manifest not found')],
+                          IMAGE, UID)
+
+
+# Fake API server
+#################
+class FakeApiServer:
+    """
+    Serves a DaemonSet scheduled on two nodes and the pods pulling its
+    image. Each pod list reports one more pod with the image than the last.
+    """
+
+    def __init__(self, pods):
+        self.pods = pods
+        self.requests = []
+        self.daemon_set = None
+        self.lists = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, body, code=200):
+                data = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def read_body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length)) if length else None
+
+            def do_POST(self):
+                server.requests.append(('POST', self.path))
+                server.daemon_set = self.read_body()
+                server.daemon_set['metadata']['uid'] = UID
+                self.send(server.daemon_set, 201)
+
+            def do_DELETE(self):
+                server.requests.append(('DELETE', self.path))
+                self.read_body()
+                self.send({'kind': 'Status', 'status': 'Success'})
+
+            def do_GET(self):
+                server.requests.append(('GET', self.path))
+                path = self.path.split('?')[0]
+                if path.endswith('/daemonsets/example-prepull'):
+                    daemon_set = dict(server.daemon_set)
+                    daemon_set['metadata'] = dict(daemon_set['metadata'], generation=1)
+                    daemon_set['status'] = {'observedGeneration': 1, 'desiredNumberScheduled': 2}
+                    return self.send(daemon_set)
+                if path.endswith('/pods') and 'watch=' in self.path:
+                    # A single event, then the watch ends
+                    line = json.dumps({'type': 'MODIFIED', 'object': server.pods(0)[0]}).encode()
+                    body = b'%x\r\n%s\n\r\n0\r\n\r\n' % (len(line) + 1, line)
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Transfer-Encoding', 'chunked')
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                if path.endswith('/pods'):
+                    server.lists += 1
+                    return self.send({'metadata': {'resourceVersion': '1'},
+                                      'items': server.pods(server.lists)})
+                self.send({'kind': 'Status', 'code': 404, 'reason': 'NotFound'}, 404)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+
+
+@pytest.fixture
+def use_server(tmp_path, monkeypatch):
+    def use(server):
+        kube_config = tmp_path / 'kubeconfig'
+        kube_config.write_text(json.dumps({
+            'apiVersion': 'v1', 'kind': 'Config', 'current-context': 'fake',
+            'clusters': [{'name': 'fake', 'cluster': {'server': server.url}}],
+            'users': [{'name': 'fake', 'user': {'token': 'token'}}],
+            'contexts': [{'name': 'fake', 'context': {'cluster': 'fake', 'user': 'fake'}}],
+        }))
+        monkeypatch.setenv('KUBECONFIG', str(kube_config))
+    return use
+
+
+def test_prepull_image_waits_for_every_node(use_server):
+    def pods(lists):
+        return [make_pod('a', image_id='sha256:1' if lists > 1 else ''),
+                make_pod('b', image_id='sha256:1' if lists > 2 else '')]
+
+    with FakeApiServer(pods) as server:
+        use_server(server)
+        assert kube.prepull_image(make_deployment(), IMAGE, 'fake', timeout=30) == 2
+
+    assert server.daemon_set['spec']['template']['spec']['initContainers'][0]['image'] == IMAGE
+    assert server.lists == 3
+    methods = [method for method, _ in server.requests]
+    assert methods[0] == 'POST'
+    assert methods[-1] == 'DELETE'
+
+
+def test_prepull_image_cleans_up_after_pull_errors(use_server):
+    def pods(lists):
+        return [make_pod('a', waiting_reason='ErrImagePull', message='manifest unknown')]
+
+    with FakeApiServer(pods) as server:
+        use_server(server)
+        with pytest.raises(ExecuteError, match='manifest unknown'):
+            kube.prepull_image(make_deployment(), IMAGE, 'fake', timeout=30)
+
+    assert server.requests[-1][0] == 'DELETE'
+
+
+def test_prepull_image_ignores_stale_pods(use_server):
+    # Pods of an earlier prepull of another tag, still being deleted
+    stale = [make_pod(name, image_id='sha256:0', image=OLD_IMAGE, owner_uid='old-uid', deleting=True)
+             for name in ('old-a', 'old-b')]
+
+    def pods(lists):
+        return stale + [make_pod('a', image_id='sha256:1' if lists > 1 else ''),
+                        make_pod('b', image_id='sha256:1' if lists > 2 else '')]
+
+    with FakeApiServer(pods) as server:
+        use_server(server)
+        assert kube.prepull_image(make_deployment(), IMAGE, 'fake', timeout=30) == 2
+
+    assert server.lists == 3